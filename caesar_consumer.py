@@ -1,6 +1,11 @@
 import ujson
 import caesar_external as ce
 import sqlite3
+import time
+
+# version of the database schema, stored in the database as PRAGMA user_version.
+# CaesarConsumer.create_db migrates older databases up to this version.
+SCHEMA_VERSION = 2
 
 class Classification(object):
   def __init__(self,
@@ -26,97 +31,175 @@ class CaesarConsumerConfig(object):
     raise NotImplementedError
 
 class CaesarConsumer(object):
-  def __init__(self, config, caesar_config_name, db_path, workflow_id, N_cl_limit):
+  def __init__(self, config, caesar_config_name, db_path, workflow_id, N_cl_limit, checkpoint_interval=60, checkpoint_size=1000):
     self.config=config # CaesarConsumer config object
     self.caesar_config_name = caesar_config_name # this could be read from a CaesarConsumer config
     self.db_path = db_path
     self.workflow = workflow_id # required to retire subjects?
     #self.workflow = Workflow.find(workflow_id)
 
-    self.subjects = {}
+    # the subject tallies are kept in memory and written to the db by save() every checkpoint_interval
+    # seconds or checkpoint_size classifications, whichever comes first.
+    # Subjects are read from the db the first time they are needed, see get_subject
+    self.subjects = {} # subject_id: [T0_tally, T1_tally, N_cl, retire]
+    self.dirty = set() # subject_ids changed since the last checkpoint
+    self.pending = [] # cl_db rows not yet written to the db
+    self.pending_ids = set()
+    self.checkpoint_id = 0 # no classification with a higher id is in the db
+    self.checkpoint_interval = checkpoint_interval
+    self.checkpoint_size = checkpoint_size
+    self.last_checkpoint = time.time()
+
     self.last_classification_id = 0
     self.db_exists = False
-    try:
-      self.create_db()
-    except sqlite3.OperationalError:
+    start = time.perf_counter()
+    self.conn = self.connect() # one connection for the life of the consumer
+    connected = time.perf_counter()
+    if self.create_db():
       print('Database exits.')
       self.db_exists = True
+    migrated = time.perf_counter()
+    if self.db_exists:
       self.load()
+    loaded = time.perf_counter()
+    print("startup: connect {:.3f}s, create/migrate db {:.3f}s, load {:.3f}s".format(connected-start, migrated-connected, loaded-migrated))
 
     self.N_cl_limit=N_cl_limit # number of classifications before retiring subjects
 
   # Check if db is empty? If all subjects are removed then the db exists but is empty
 
+  def connect(self):
+    # open the database at self.db_path, tuned for a single long running writer
+    conn = sqlite3.connect(self.db_path)
+    conn.execute('PRAGMA journal_mode=WAL') # readers don't block the consumer, and commits are appends to the log
+    conn.execute('PRAGMA synchronous=NORMAL') # with WAL this is still crash safe, without an fsync on every commit
+    conn.execute('PRAGMA cache_size=-65536') # 64MB page cache
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+  def close(self):
+    self.conn.close()
+
   def create_db(self):
-    # initialise database at self.db_path
+    # initialise database at self.db_path, or bring an existing one up to SCHEMA_VERSION.
+    # Returns True if the database already existed.
     # e.g. https://github.com/miclaraia/swap-2/blob/7d2ed2feb417c02ddd60e22f7977727d09de8ebb/swap/data/__init__.py#L30
-    print('Build database')
+    version=self.conn.execute('PRAGMA user_version').fetchone()[0]
+    exists=self.conn.execute("SELECT COUNT(1) FROM sqlite_master WHERE type='table' AND name='cl_db'").fetchone()[0]==1
+
+    if not exists:
+      print('Build database')
+    migrations=[self.migrate_1, self.migrate_2]
+    for to_version in range(version+1, SCHEMA_VERSION+1):
+      if exists:
+        print('Migrate database to schema version {}'.format(to_version))
+      # each migration runs in its own transaction, so a failed migration leaves the database as it was
+      self.conn.execute('BEGIN')
+      try:
+        migrations[to_version-1](exists)
+        self.conn.execute('PRAGMA user_version = {:d}'.format(to_version))
+        self.conn.commit()
+      except:
+        self.conn.rollback()
+        raise
+    return exists
+
+  def migrate_1(self, exists):
+    # typed tables with primary keys, so the per classification and per subject lookups use an index
+    if exists: # databases from before the schema was versioned
+      self.conn.execute('''ALTER TABLE cl_db RENAME TO cl_db_0''')
+      self.conn.execute('''ALTER TABLE sub_db RENAME TO sub_db_0''')
 
     # Create database with several tables
-    conn = sqlite3.connect(self.db_path)
-    conn.execute('''CREATE TABLE cl_db (id, subject_id, T0, T1,processed)''') # table of all incoming classifications
-    conn.execute('''CREATE TABLE sub_db (subject_id, T0_tally, T1_tally, N_cl, retire)''') # table of the subjects with running tally of T0 and T1 for each subject
-    conn.close()
+    self.conn.execute('''CREATE TABLE cl_db (id INTEGER PRIMARY KEY, subject_id INTEGER, T0, T1, processed INTEGER)''') # table of all incoming classifications
+    self.conn.execute('''CREATE TABLE sub_db (subject_id INTEGER PRIMARY KEY, T0_tally, T1_tally, N_cl INTEGER, retire INTEGER)''') # table of the subjects with running tally of T0 and T1 for each subject
+    self.conn.execute('''CREATE INDEX cl_db_subject_id ON cl_db (subject_id)''')
+
+    if exists:
+      self.conn.execute('''INSERT OR IGNORE INTO cl_db SELECT id, subject_id, T0, T1, processed FROM cl_db_0 ORDER BY rowid''')
+      self.conn.execute('''INSERT OR IGNORE INTO sub_db SELECT subject_id, T0_tally, T1_tally, N_cl, retire FROM sub_db_0 ORDER BY rowid''')
+      self.conn.execute('''DROP TABLE cl_db_0''')
+      self.conn.execute('''DROP TABLE sub_db_0''')
+
+  def migrate_2(self, exists):
+    # small table of the consumer state, so startup doesn't have to read cl_db.
+    # last_id is the highest classification id in cl_db, updated at each checkpoint
+    self.conn.execute('''CREATE TABLE meta (key TEXT PRIMARY KEY, value)''')
+    self.conn.execute('''INSERT INTO meta SELECT 'last_id', COALESCE(MAX(id),0) FROM cl_db''')
 
   def load(self):
     # load state from self.db_path
     # e.g. https://github.com/miclaraia/swap-2/blob/7d2ed2feb417c02ddd60e22f7977727d09de8ebb/swap/utils/control.py#L86
     print('Load from database')
 
-    # connect to the existing db and update the last classification id
-    conn = sqlite3.connect(self.db_path)
-    ids=conn.execute("SELECT id FROM cl_db")
+    # update the last classification id from the existing db, recorded in meta at each checkpoint
+    row=self.conn.execute("SELECT value FROM meta WHERE key='last_id'").fetchone()
+    if row==None: # otherwise use the primary key index of cl_db
+        row=self.conn.execute("SELECT COALESCE(MAX(id),0) FROM cl_db").fetchone()
     # N.B. that the loaded db might be empty (e.g. if all subjects were retired)
-    try:
-        last_id=int(ids.fetchall()[-1][0])
-    except:
-        last_id=0
+    last_id=int(row[0])
     print("the last id in the db is: {}".format(last_id))
     self.last_classification_id=last_id
-
-  def save(self):
-    # save state to self.db_path
+    self.checkpoint_id=last_id # no classification with a higher id is in the db
+
+    # the subject tallies are not read here, get_subject reads each subject when it is first classified
+    self.subjects={}
+
+  def get_subject(self, subject_id):
+    # the [T0_tally, T1_tally, N_cl, retire] of a subject, from memory or else from sub_db, or None for a new subject
+    subject=self.subjects.get(subject_id)
+    if subject==None:
+        row=self.conn.execute("SELECT T0_tally, T1_tally, N_cl, retire FROM sub_db WHERE subject_id=?",(subject_id,)).fetchone()
+        if row==None:
+            return None
+        subject=self.subjects[subject_id]=list(row)
+    return subject
+
+  def save(self, force=False):
+    # checkpoint the classifications and changed subject tallies held in memory to self.db_path, once
+    # checkpoint_size classifications are waiting or checkpoint_interval seconds have passed (or if force).
+    # Returns True if the db is now up to date with memory.
     # e.g. https://github.com/miclaraia/swap-2/blob/7d2ed2feb417c02ddd60e22f7977727d09de8ebb/swap/utils/control.py#L113
-    # print('Save to database')
-    # This currently does nothing! More important if SWAP is implemented?
-    return
+    if len(self.pending)==0 and len(self.dirty)==0:
+        return True
+    if not force and len(self.pending)<self.checkpoint_size and time.time()-self.last_checkpoint<self.checkpoint_interval:
+        return False
+
+    print('Save to database')
+    checkpoint_id=max([self.checkpoint_id]+list(self.pending_ids))
+    with self.conn: # one transaction, so a crash leaves the db at the previous checkpoint
+        self.conn.executemany("INSERT OR IGNORE INTO cl_db VALUES (?,?,?,?,?)",self.pending)
+        self.conn.executemany('''INSERT INTO sub_db VALUES (?,?,?,?,?)
+                                 ON CONFLICT(subject_id) DO UPDATE SET T0_tally = excluded.T0_tally,
+                                                                       T1_tally = excluded.T1_tally,
+                                                                       N_cl = excluded.N_cl,
+                                                                       retire = excluded.retire''',
+                              [[subject_id]+self.subjects[subject_id] for subject_id in self.dirty])
+        self.conn.execute("INSERT OR REPLACE INTO meta VALUES ('last_id',?)",(checkpoint_id,))
+
+    self.checkpoint_id=checkpoint_id
+    self.pending=[]
+    self.pending_ids=set()
+    self.dirty=set()
+    self.last_checkpoint=time.time()
+    return True
 
   def recieve(self, ce):
     data = ce.Extractor.next()
     haveItems = False
-    subject_batch = []
+    classifications = []
 
     for i, item in enumerate(data):
       haveItems = True
       print(item)
       id = int(item['id'])
-
-      # Ensure that we skip over classifications that have already been processed
-      # Assumes that ids are always increasing
-      # if id <= self.last_classification_id:
-      #   print("already processed")
-      #   continue
-
-      # Connect to the database and record the cl details
-      conn = sqlite3.connect(self.db_path)
-      c = conn.cursor()
-      c.execute("SELECT COUNT(1) FROM cl_db where id={}".format(id)) # Insert a row of data
-      cl_id_check=c.fetchone()[0]
-      print("cl_id_check = {}".format(cl_id_check))
-      conn.commit()
-
-      if cl_id_check!=0:
-          print("already processed")
-          continue
-
       subject_id = int(item['subject'])
       annotation = item['annotations']
       # print("\nsubject_id: {}, annotation: {}\n".format(subject_id,annotation))
-      cl = Classification(id, subject_id, annotation)
-      self.process_classification(cl)
-      self.last_classification_id = id # update the id
-      subject_batch.append(subject_id)
+      classifications.append(Classification(id, subject_id, annotation))
 
+    # record the whole batch in one go
+    subject_batch = self.process_classifications(classifications)
     return haveItems, subject_batch
 
   def consume(self):
@@ -126,92 +209,80 @@ class CaesarConsumer(object):
         haveItems, subject_batch = self.recieve(ce)
         print(haveItems, subject_batch)
         if haveItems:
-          self.save()
-          ce.Config.instance().save()
-          # load the just saved ce config
-          ce.Config.load(self.caesar_config_name)
           self.send(subject_batch)
+          # only move the ce config past these classifications once they are checkpointed to the db
+          if self.save():
+            ce.Config.instance().save()
+            # load the just saved ce config
+            ce.Config.load(self.caesar_config_name)
 
           # break # COMMENT THIS LINE OUT FOR LIVE RUNS add an exit to stop infinite loop through the one classifaction file! (normally there would a continuous stream)
 
     except KeyboardInterrupt as e:
       print('Received KeyboardInterrupt {}'.format(e))
-      self.save()
+      if self.save(force=True):
+        ce.Config.instance().save()
       # print('Terminating SWAP instance.') # we are not doing SWAP right now
 
   def process_classification(self, cl):
-
-    id=cl.id
-    subject_id=cl.subject_id
-    T0_val=cl.label['T0']
-
-    print("process cl: {}".format(id))
-
-    # T0 should always have an answer, otherwise there must have been an error
-    # Throw away for now, but possibly move this so that the dodgy cl is recorded in the db?
-    if T0_val=='None':
-        print("Classification has T0='None', there should be an answer -> Skip!")
-        return
-
-    # T1 is not always answered
-    try:
-        T1_val=cl.label['T1']
-    except:
-        T1_val="None"
-
-    # Some of the cls have "None" as a value. *** Count these as zero in the tally (or discount them?) **
-    # N.B. how does counting None as zero affect the N_cl count?
-    T_tally=[]
-    for T_val in [T0_val,T1_val]:
-        if T_val=="None":
-            T_tally.append(0)
-        else:
-            T_tally.append(T_val)
-
-    process=0 # flag to check which cls have been processed into the sub_db table
-
-    # Connect to the database and record the cl details
-    conn = sqlite3.connect(self.db_path)
-    c = conn.cursor()
-    c.execute("INSERT INTO cl_db VALUES (?,?,?,?,?)",(id,subject_id,T0_val,T1_val,process)) # Insert a row of data
-    conn.commit()
-
-    # Check if this subject already exists in sub_db
-    c.execute("SELECT COUNT(1) FROM sub_db WHERE subject_id=(?)",(subject_id,))
-    subject_check=c.fetchone()[0]
-
-    if subject_check==1: # the subject is already in sub_db
-        # check if we have already retired the subject
-        c.execute("SELECT retire FROM sub_db WHERE subject_id=(?)",(subject_id,))
-        retire_check=c.fetchone()[0]
-        if retire_check==1:
-            print("Subject {} has already been retired, skip cl {}".format(subject_id,id))
-            conn.close()
-            return
-        # subject exists and is not retired, update values
-        print("Update subject {}".format(subject_id))
-        c.execute("UPDATE sub_db SET T0_tally = T0_tally + ?, T1_tally = T1_tally + ?, N_cl = N_cl + 1 WHERE subject_id = ?",(T_tally[0],T_tally[1],subject_id))
-        conn.commit()
-
-    elif subject_check==0: # the subject is not in sub_db
-        # add the new subject to sub_db table
-        # initialise with the T0/T1 results of this first classification and start the counts at 1
-        print("New subject {}".format(subject_id))
-        N_cl=1 # count number of classifications
-        retire=0 # flag to decide what to retire (0 = keep, 1 = retire)
-
-        c.execute("INSERT INTO sub_db VALUES (?,?,?,?,?)",(subject_id,T_tally[0],T_tally[1],N_cl,retire))
-        conn.commit()
-
-    else: # catch weird error if subject_check does not equal 1 or 0
-        raise ValueError("subject_check does not equal 1 or 0, error in subject table?") # if subject_check>1 we might have multiple entries for a subject?
-
-    # mark the classification as processed
-    c.execute("UPDATE cl_db SET processed = 1 WHERE subject_id=(?)",(subject_id,))
-    conn.commit()
-
-    conn.close()
-    return
+    return self.process_classifications([cl])
+
+  def process_classifications(self, classifications):
+    # add a batch of classifications to the in-memory subject tallies, queueing them to be written
+    # to cl_db at the next checkpoint. Returns the subject ids of the classifications not seen before.
+    subject_batch=[]
+
+    for cl in classifications:
+        id=cl.id
+        subject_id=cl.subject_id
+        T0_val=cl.label['T0']
+
+        print("process cl: {}".format(id))
+
+        # T0 should always have an answer, otherwise there must have been an error
+        # Throw away for now, but possibly move this so that the dodgy cl is recorded in the db?
+        if T0_val=='None':
+            print("Classification has T0='None', there should be an answer -> Skip!")
+            self.last_classification_id = id # update the id
+            subject_batch.append(subject_id)
+            continue
+
+        # Ensure that we skip over classifications that have already been processed.
+        # Only ids up to the last checkpoint can be in the db, newer ones are all in memory
+        if id in self.pending_ids or (id<=self.checkpoint_id and self.conn.execute("SELECT 1 FROM cl_db WHERE id=?",(id,)).fetchone()!=None):
+            print("already processed")
+            continue
+        self.last_classification_id = id # update the id
+        subject_batch.append(subject_id)
+
+        # T1 is not always answered
+        try:
+            T1_val=cl.label['T1']
+        except:
+            T1_val="None"
+
+        subject=self.get_subject(subject_id)
+        if subject==None: # new subjects start with no tally and not retired
+            subject=self.subjects[subject_id]=[0,0,0,0]
+        retired=subject[3]==1
+
+        # the processed flag records whether the cl counts towards the subject tally
+        process=0 if retired else 1
+        self.pending.append((id,subject_id,T0_val,T1_val,process))
+        self.pending_ids.add(id)
+
+        if retired:
+            continue
+
+        # Some of the cls have "None" as a value. *** Count these as zero in the tally (or discount them?) **
+        # N.B. how does counting None as zero affect the N_cl count?
+        for i, T_val in enumerate([T0_val,T1_val]):
+            if T_val!="None":
+                subject[i]+=T_val
+        subject[2]+=1
+        self.dirty.add(subject_id)
+
+    return subject_batch
 
 
   def send(self, subject_batch):
@@ -235,31 +306,20 @@ class CaesarConsumer(object):
 
   def retire(self, subject_batch):
     #check what needs retired (e.g. number of classifications=10 for T0)
-    # use the N_cl field in the sub_db table
+    # use the N_cl tally of each subject
     #flag retired in subject db
     to_retire = []
 
-    conn = sqlite3.connect(self.db_path)
-    c = conn.cursor()
-
     # find all subjects in this batch that have been classified N_cl_limit times
-    if len(subject_batch)==1:
-        c.execute("SELECT subject_id FROM sub_db WHERE subject_id={} AND N_cl >= {}".format(subject_batch[0],self.N_cl_limit))
-    else:
-        c.execute("SELECT subject_id FROM sub_db WHERE subject_id IN {} AND N_cl >= {}".format(tuple(subject_batch),self.N_cl_limit))
-
-    # read the retire query
-    for row in c:
-        to_retire.append(row[0])
-
-    # update retire flag for these subjects
-    if len(to_retire)==1:
-        c.execute("UPDATE sub_db SET retire = 1 WHERE subject_id={}".format(to_retire[0]))
-    else:
-        c.execute("UPDATE sub_db SET retire = 1 WHERE subject_id IN {}".format(tuple(to_retire)))
-    conn.commit()
-
-    conn.close()
+    for sid in sorted(set(subject_batch)):
+        subject=self.get_subject(sid)
+        if subject!=None and subject[2]>=self.N_cl_limit:
+            to_retire.append(sid)
+
+            # update retire flag for these subjects
+            subject[3]=1
+            self.dirty.add(sid)
+
     return to_retire
 
   def send_panoptes(self, to_retire):
@@ -272,19 +332,9 @@ class CaesarConsumer(object):
   def send_lasair(self, to_retire):
     # accepts list of subject_ids to retire, need to associate this list with a lasair object id
     print("Post subject classifications back to lasair: {}".format(to_retire))
-    conn = sqlite3.connect(self.db_path)
-    c = conn.cursor()
     for sid in to_retire:
         # for each subject_id
-        c.execute("SELECT T0_tally FROM sub_db WHERE subject_id=(?)",(sid,))
-        T0_tally=c.fetchone()[0]
-        # print(T0_tally)
-        c.execute("SELECT T1_tally FROM sub_db WHERE subject_id=(?)",(sid,))
-        T1_tally=c.fetchone()[0]
-        # print(T1_tally)
-        c.execute("SELECT N_cl FROM sub_db WHERE subject_id=(?)",(sid,))
-        N_cl=c.fetchone()[0]
-        # print(N_cl)
+        T0_tally, T1_tally, N_cl = self.get_subject(sid)[:3]
 
         # calculate the results for T0 and T1 as a fraction
         T0_result=float(T0_tally)/float(N_cl)
@@ -294,7 +344,6 @@ class CaesarConsumer(object):
         # ADD CODE HERE:
         # match subject_id to LasairURL (use panoptes to retrieve the subject meta-data?) and pass the T0_result and T1_result
 
-    conn.close()
     return
 
 # db_path="example.db"
@@ -303,6 +352,7 @@ class CaesarConsumer(object):
 db_path="live_test_05_08_2020.db"
 consumer = CaesarConsumer(config=None, caesar_config_name='slsn_online', db_path=db_path, workflow_id=None, N_cl_limit=3)
 consumer.consume()
+consumer.close()
 
 # Read the classifications in the db file
 conn = sqlite3.connect(db_path)
@@ -3,6 +3,9 @@ import numpy as np
 import pandas as pd
 from datetime import datetime
 import string
+import hashlib
+import json
+import os
 
 def generate_random_str(str_set=np.array(list(string.ascii_lowercase)),N=3):
     '''
@@ -28,34 +31,124 @@ def create_proto_subjects(subject_data_csv,file_path,file_header="filename"):
     file_header -- the csv column containing the subject filenames (all other columns are metadata)
     '''
 
-    # load the csv containing filenames and metadata
-    df_subjects=pd.read_csv(subject_data_csv)
-    csv_headers=np.array(list(df_subjects))
-    meta_headers=csv_headers[~(csv_headers==file_header)] # retrieve the headers of only the metadata
+    # create the subject data: metadata dictionary from the csv file info
+    proto_subjects=dict(iter_proto_subjects(subject_data_csv,file_path,file_header))
+    print("read {} subjects from {}".format(len(proto_subjects),subject_data_csv))
 
-    # get the list of file names from the csv
-    files=df_subjects[file_header]
+    return proto_subjects
 
-    # generate the metadata dict from all other columns
-    metadata=df_subjects[meta_headers].to_dict(orient='records')
-    print(metadata)
+def iter_proto_subjects(subject_data_csv,file_path,file_header="filename",chunksize=1000):
+    '''
+    Generator of the (subject filename, subject metadata) pairs in the csv, reading chunksize rows at a time
+    so the whole csv is never held in memory and subjects can be uploaded while the rest is still being read.
 
-    # create the subject data: metadata dictionary from the csv file info
-    proto_subjects={}
-    for i in range(len(files)):
-        proto_subjects['{}/{}'.format(file_path,files[i])]={} # create the dict key
-        proto_subjects['{}/{}'.format(file_path,files[i])].update(metadata[i]) # add the nested dict metadata
+    Keyword Arguments:
+    subject_data_csv -- the csv containing subject filename and metadata columns
+    file_path -- location of the subject files
+    file_header -- the csv column containing the subject filenames (all other columns are metadata)
+    chunksize -- number of rows of the csv to read at a time
+    '''
 
-    return proto_subjects
+    for df_subjects in pd.read_csv(subject_data_csv,chunksize=chunksize):
+        meta_headers=[h for h in df_subjects.columns if h!=file_header] # retrieve the headers of only the metadata
+
+        # generate the metadata dict from all other columns
+        metadata=df_subjects[meta_headers].to_dict(orient='records')
+        for filename,meta in zip(df_subjects[file_header],metadata):
+            yield file_path+'/'+str(filename),meta
+
+def metadata_key(metadata):
+    '''
+    hash of the subject metadata, the same however the metadata was read (csv or panoptes)
+    so a new subject can be checked against those already uploaded in constant time
 
-def create_subjects_and_link_to_project(proto_subjects, project_id, subject_set_id, subject_set_name=None):
+    Keyword Arguments:
+    metadata -- dictionary of the subject metadata
+    '''
+
+    canonical={}
+    for k,v in metadata.items():
+        if hasattr(v,'item'): # numpy scalars from pandas
+            v=v.item()
+        if isinstance(v,float) and v.is_integer(): # 1.0 and 1 are the same value
+            v=int(v)
+        canonical[str(k)]=v
+    return hashlib.sha1(json.dumps(canonical,sort_keys=True,default=str).encode('utf-8')).hexdigest()
+
+def load_subject_index(subject_set_id,index_dir='.'):
+    '''
+    load the local index of the subjects in a subject set: the ids of the subjects and the metadata_key of each
+
+    Keyword Arguments:
+    subject_set_id -- identifier of the subject set
+    index_dir -- directory the index files are kept in
+    '''
+
+    path=os.path.join(index_dir,'subject_index_{}.json'.format(subject_set_id))
+    subject_index={'path':path,'subject_ids':set(),'keys':set()}
+    try:
+        with open(path,'r') as f:
+            data=json.load(f)
+        subject_index['subject_ids']=set(data['subject_ids'])
+        subject_index['keys']=set(data['keys'])
+    except (IOError,ValueError,KeyError):
+        pass
+    return subject_index
+
+def save_subject_index(subject_index):
+    '''
+    write the local subject index back to disk
+
+    Keyword Arguments:
+    subject_index -- index returned by load_subject_index
+    '''
+
+    os.makedirs(os.path.dirname(os.path.abspath(subject_index['path'])),exist_ok=True)
+    with open(subject_index['path']+'.part','w') as f:
+        json.dump({'subject_ids':sorted(subject_index['subject_ids']),'keys':sorted(subject_index['keys'])},f)
+    os.replace(subject_index['path']+'.part',subject_index['path'])
+
+def refresh_subject_index(subject_index,subject_set,page_size=100):
+    '''
+    bring the local subject index up to date with the subject set on panoptes.
+    Nothing is fetched unless the subject set has more subjects than the index, and then only
+    the pages past those already indexed, unless that fails to find them all.
+
+    Keyword Arguments:
+    subject_index -- index returned by load_subject_index
+    subject_set -- the panoptes subject set
+    page_size -- number of subjects to request per page
+    '''
+
+    remote_count=subject_set.raw.get('set_member_subjects_count') or 0
+    if len(subject_index['subject_ids'])>=remote_count:
+        return
+
+    # subjects are listed in the order they were added, so start from the first page not yet indexed
+    first_page=len(subject_index['subject_ids'])//page_size+1
+    for subject in Subject.where(subject_set_id=subject_set.id,page_size=page_size,page=first_page):
+        subject_index['subject_ids'].add(subject.id)
+        subject_index['keys'].add(metadata_key(subject.metadata))
+
+    # if subjects were removed from the set the pages will have moved, so fall back to listing the whole set
+    if len(subject_index['subject_ids'])<remote_count:
+        for subject in Subject.where(subject_set_id=subject_set.id,page_size=page_size):
+            subject_index['subject_ids'].add(subject.id)
+            subject_index['keys'].add(metadata_key(subject.metadata))
+
+    save_subject_index(subject_index)
+
+def create_subjects_and_link_to_project(proto_subjects, project_id, subject_set_id, subject_set_name=None, index_dir='.', link_batch_size=100):
     ''' find the project and relevant subject set. Get the existing subject data and compare to the new proto_subjects.
     Upload any instances of nbew subjects to the project
 
     Keyword Arguments:
-    proto_subjects -- dictionary structure containing subject filepath+filename, and associated metadata
+    proto_subjects -- dictionary structure containing subject filepath+filename, and associated metadata,
+                      or an iterable of (filepath+filename, metadata) pairs such as iter_proto_subjects
     project_id -- identifier to find and link with the project
     subject_set_id -- identifier for the subject set of interest
+    index_dir -- directory to keep the local index of the subjects already in each subject set
+    link_batch_size -- number of new subjects to upload before linking them to the subject set
     '''
 
     # get the project object
@@ -85,20 +178,23 @@ def create_subjects_and_link_to_project(proto_subjects, project_id, subject_set_
 
         print("add to existing subject set: {}".format(subject_set_name))
 
-    # Create a list of the existing subject metadata
-    meta_list=[]
-    print("existing subjects:")
-    for subject in subject_set.subjects:
-        print(subject.id,subject.metadata)
-        meta_list.append(subject.metadata)
+    # Index the metadata of the existing subjects, only fetching those added since the last run
+    subject_index=load_subject_index(subject_set.id,index_dir)
+    refresh_subject_index(subject_index,subject_set)
+    print("existing subjects: {}".format(len(subject_index['subject_ids'])))
+
+    if isinstance(proto_subjects,dict):
+        proto_subjects=proto_subjects.items()
 
     # When making list of subjects to add, check to see if the metadata of the subject you want to add is already in the set
     print("new subjects:")
     new_subjects = []
-    for filename, metadata in proto_subjects.items():
+    new_keys = set()
+    for filename, metadata in proto_subjects:
 
-        # check if this subject is already in the subject set
-        if np.isin(metadata,meta_list):
+        # check if this subject is already in the subject set (or earlier in this upload)
+        key=metadata_key(metadata)
+        if key in subject_index['keys'] or key in new_keys:
             print("{}, subject already in set".format(metadata))
             # In this case we skip over the subject that already exists.
             # N.B. you may want to remove an existing subject and update it with the new one
@@ -115,15 +211,38 @@ def create_subjects_and_link_to_project(proto_subjects, project_id, subject_set_
 
             subject.save()
             new_subjects.append(subject)
+            new_keys.add(key)
             print("{}, new subject add to list".format(metadata))
 
-    print("new subjects to add: {}".format(new_subjects))
+            # link the subjects as we go so they are not all held until the end
+            if len(new_subjects)>=link_batch_size:
+                link_subjects(subject_set,new_subjects,new_keys,subject_index)
+                new_subjects,new_keys=[],set()
 
-    # add the new subject list (data and metadata) to the already defined project subject set
-    subject_set.add(new_subjects)
+    link_subjects(subject_set,new_subjects,new_keys,subject_index)
 
     return
 
+def link_subjects(subject_set,new_subjects,new_keys,subject_index):
+    '''
+    add the new subjects (data and metadata) to the subject set and record them in the local index
+
+    Keyword Arguments:
+    subject_set -- the panoptes subject set
+    new_subjects -- list of saved subjects to add
+    new_keys -- the metadata_key of each of the new subjects
+    subject_index -- index returned by load_subject_index
+    '''
+
+    if len(new_subjects)==0:
+        return
+    print("new subjects to add: {}".format(new_subjects))
+    subject_set.add(new_subjects)
+
+    subject_index['subject_ids'].update(subject.id for subject in new_subjects)
+    subject_index['keys'].update(new_keys)
+    save_subject_index(subject_index)
+
 # set a date variable so that we can generate a random name for a subject set
 date = datetime.today()
 
@@ -154,15 +273,12 @@ print("subject set id = {}".format(subject_set_id))
 
 # Add some new subjects to the list
 subject_data_csv="tutorial_project_subjects.csv"
-df_subjects=pd.read_csv(subject_data_csv)
-
-# print(df_subjects)
 
 # define the subject file data
 file_path="/Users/jrobinson/xq1_grav_cloud/binary_stability/orbit_results/orbit_results_plots/all_plots_fixed/main_analysis/binary_nodes"
 
-proto_subjects=create_proto_subjects(subject_data_csv=subject_data_csv,file_header="filename",file_path=file_path)
-
-# print(proto_subjects)
+# read the csv a chunk at a time, uploading as it goes
+# (create_proto_subjects reads it all into a dictionary first)
+proto_subjects=iter_proto_subjects(subject_data_csv=subject_data_csv,file_header="filename",file_path=file_path)
 
 create_subjects_and_link_to_project(proto_subjects=proto_subjects, project_id=project_id, subject_set_id=subject_set_id,subject_set_name="test set")
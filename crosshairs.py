@@ -0,0 +1,129 @@
+import io
+import logging
+import numpy as np
+from PIL import Image, ImageDraw
+from concurrent.futures import ThreadPoolExecutor
+
+# longest side in pixels of the annotated PS1 stamp shown to volunteers
+stamp_size = 300
+crosshair_color = '#00ff00'
+crosshair_rgb = (0, 255, 0)
+
+# crosshair masks already drawn, keyed by image size
+_masks = {}
+
+def crosshair_lines(imWidth, imHeight):
+    # the four line segments of a crosshair marking the centre of an image of
+    # this size, and the width to draw them with
+
+    # THE CROSS HAIRS SHOULD BE 1/6 THE LENGTH OF THE SMALLEST DIMENSON
+    chLen = int(min(imWidth, imHeight) / 6)
+
+    # THE GAP IN THE CENTRE SHOULD BE 1/60 OF THE LENGTH OF THE SMALLEST DIMENSON
+    gapLen = int(min(imWidth, imHeight) / 60)
+
+    # LINE WIDTH SHOULD BE EASILY VIEWABLE AT ALL SIZES - 0.2% OF THE WIDTH SEEMS GOOD
+    lineWidth = max(1, int(max(imWidth, imHeight) / 300))
+
+    lines = [
+        (imWidth / 2 - gapLen - chLen, imHeight / 2, imWidth / 2 - gapLen, imHeight / 2),
+        (imWidth / 2 + gapLen, imHeight / 2, imWidth / 2 + gapLen + chLen, imHeight / 2),
+        (imWidth / 2, imHeight / 2 - gapLen - chLen, imWidth / 2, imHeight / 2 - gapLen),
+        (imWidth / 2, imHeight / 2 + gapLen, imWidth / 2, imHeight / 2 + gapLen + chLen),
+    ]
+    return lines, lineWidth
+
+def load_thumbnail(path, size=stamp_size):
+    # open a stamp already scaled down to fit in size x size pixels.  draft
+    # lets the jpeg decoder scale by 1/2, 1/4 or 1/8 while decoding, so the
+    # full 1200px stamp is never decoded, and LANCZOS takes it the rest of
+    # the way down.
+    with Image.open(path) as im:
+        im.draft('RGB', (size, size))
+        im.thumbnail((size, size), Image.LANCZOS)
+        return im.copy()
+
+def draw_crosshairs(path, size=stamp_size, as_bytes=False):
+    """
+    Scale the stamp at path down to size pixels and draw crosshairs on it at
+    that size, so the image is decoded and encoded only once.  The result is
+    written back over path, whose path is returned, or with as_bytes=True
+    returned as the bytes of the jpeg without touching the disk.
+    """
+    im = load_thumbnail(path, size)
+
+    lines, lineWidth = crosshair_lines(*im.size)
+    draw = ImageDraw.Draw(im)
+    for l in lines:
+        draw.line(l, fill=crosshair_color, width=lineWidth)
+    del draw
+
+    if as_bytes:
+        buffer = io.BytesIO()
+        im.save(buffer, "JPEG")
+        return buffer.getvalue()
+    im.save(path, "JPEG")
+    return path
+
+def crosshair_mask(imWidth, imHeight):
+    # boolean array, True where the crosshair covers an image of this size.
+    # Every stamp thumbnailed to the same size shares the same mask, so it is
+    # drawn only once.
+    if (imWidth, imHeight) not in _masks:
+        im = Image.new('L', (imWidth, imHeight), 0)
+        lines, lineWidth = crosshair_lines(imWidth, imHeight)
+        draw = ImageDraw.Draw(im)
+        for l in lines:
+            draw.line(l, fill=255, width=lineWidth)
+        del draw
+        _masks[(imWidth, imHeight)] = np.asarray(im) > 0
+    return _masks[(imWidth, imHeight)]
+
+def annotate_stamps(paths, size=stamp_size, as_bytes=False, workers=8):
+    """
+    draw_crosshairs for a whole batch of stamps.  The stamps are decoded and
+    thumbnailed in parallel, stacked into one array per image size and the
+    crosshair mask is applied to each stack in a single operation, before the
+    stamps are encoded in parallel.  Returns a list with the path (or bytes)
+    of each annotated stamp, or None for any stamp that failed.
+    """
+    log = logging.getLogger("crosshairs-logger")
+
+    def load(path):
+        try:
+            return np.asarray(load_thumbnail(path, size).convert('RGB'))
+        except Exception:
+            log.exception("Error loading stamp: " + path)
+            return None
+
+    def save(job):
+        path, pixels = job
+        try:
+            im = Image.fromarray(pixels)
+            if as_bytes:
+                buffer = io.BytesIO()
+                im.save(buffer, "JPEG")
+                return buffer.getvalue()
+            im.save(path, "JPEG")
+            return path
+        except Exception:
+            log.exception("Error saving stamp: " + path)
+            return None
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        images = list(executor.map(load, paths))
+
+        # after thumbnailing the stamps almost always share one size
+        shapes = {}
+        for i, pixels in enumerate(images):
+            if pixels is not None:
+                shapes.setdefault(pixels.shape, []).append(i)
+        for shape, indices in shapes.items():
+            stack = np.stack([images[i] for i in indices])
+            stack[:, crosshair_mask(shape[1], shape[0])] = crosshair_rgb
+            for i, pixels in zip(indices, stack):
+                images[i] = pixels
+
+        jobs = [(path, pixels) for path, pixels in zip(paths, images) if pixels is not None]
+        saved = iter(executor.map(save, jobs))
+        return [next(saved) if pixels is not None else None for pixels in images]
@@ -18,9 +18,158 @@ The stamp server can be found `here <http://plpsipp1v.stsci.edu/cgi-bin/ps1cutou
 import sys
 import os
 import re
+import bisect
 os.environ['TERM'] = 'vt100'
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from urllib3.util.retry import Retry
 from fundamentals import tools
 
+# PATTERNS FOR PARSING THE PS1 CUTOUT PAGE, COMPILED ONCE AT IMPORT
+reFitscutouts = re.compile(
+    r"""<th>(?P<imagetype>\w+)\s+(?P<skycellid>\d+.\d+)\s+(?P<ffilter>[\w\\]+)(\s+(?P<mjd>\d+\.\d+))?(\s<a.*\(warning\)</a>)?<br.*?href="(http:)?//plpsipp1v.*?Display</a>.*?Fits cutout" href="(?P<fiturl>(http:)?//plpsipp1v.*?\.fits)".*?</th>""", re.I)
+reJpegs = re.compile(
+    r"""<img src="(?P<jpegUrl>(http:)?//plp.*?skycell.*?)\"""", re.I)
+reStackMeta = re.compile(
+    r'http?.*?\?.*?skycell\.(?P<skycell>\d+\.\d+).*?x=(?P<ra>\d+\.\d+).*?y=(?P<dec>[+|-]?\d+\.\d+).*?size=(?P<pixels>\d+).*?stk\.(?P<ffilter>\w+).*?fits', re.S | re.I)
+reWarpMeta = re.compile(
+    r'http?.*?\?.*?skycell\.(?P<skycell>\d+\.\d+).*?x=(?P<ra>\d+\.\d+).*?y=(?P<dec>[+|-]?\d+\.\d+).*?size=(?P<pixels>\d+).*?wrp\.(?P<ffilter>\w+)\.(?P<mjd>\d+\.\d+).*?fits', re.S | re.I)
+reColorMeta = re.compile(
+    r'(?P<color>\w+)=(?P<datapath>/data.*?)&', re.S | re.I)
+
+
+def _datapath(url):
+    """
+    *the ``red=/data/...fits`` datapath of a cutout url, shared by an image's jpeg and fits urls*
+    """
+    return url.split("&")[0].split("?")[-1].replace("%3A", ":")
+
+
+# ONE POOLED KEEP-ALIVE SESSION SHARED BY ALL REQUESTS TO THE STAMP SERVER
+_session = None
+
+
+def shared_session(
+        poolSize=10,
+        retries=3):
+    """
+    *the requests session shared by all stamp server requests*
+
+    **Key Arguments:**
+        - ``poolSize`` -- the number of connections to keep open to the stamp server. Only used the first time the session is created. Default *10*
+        - ``retries`` -- the number of times to retry a failed request, with exponential backoff. Only used the first time the session is created. Default *3*
+
+    **Return:**
+        - ``session`` -- a ``requests.Session`` with a pooled connection adapter
+    """
+    global _session
+    if _session is None:
+        retry = Retry(
+            total=retries,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504]
+        )
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=poolSize,
+            max_retries=retry
+        )
+        _session = requests.Session()
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+class warp_epoch_index():
+    """
+    *a sorted index of the warps of one sky position by epoch*
+
+    Built once from a parsed cutout page, the index answers closest-epoch, time-window and MJD-range queries with a binary search, so it can be queried for many epochs of the same object without rescanning the warps.
+
+    **Key Arguments:**
+        - ``epochs`` -- list of (mjd, warp) tuples, in any order
+
+    **Usage:**
+
+        .. code-block:: python 
+
+            index = warp_epoch_index([(55197.4, warpA), (55210.3, warpB)])
+            mjd, warp = index.closest(55200.)
+            warps = index.within(55200., window=86400 * 14)
+    """
+
+    def __init__(
+            self,
+            epochs):
+        # STABLE SORT, SO WARPS SHARING AN EPOCH KEEP THEIR PAGE ORDER
+        epochs = sorted(epochs, key=lambda e: e[0])
+        self.mjds = [e[0] for e in epochs]
+        self.warps = [e[1] for e in epochs]
+
+    def __len__(self):
+        return len(self.mjds)
+
+    def _epoch(self, i):
+        return self.mjds[i], self.warps[i]
+
+    def closest_after(
+            self,
+            mjd):
+        """
+        *the (mjd, warp) of the first warp taken after ``mjd``, or None*
+        """
+        i = bisect.bisect_right(self.mjds, mjd)
+        if i == len(self.mjds):
+            return None
+        # OF SEVERAL WARPS SHARING THE EPOCH, TAKE THE LAST ON THE PAGE
+        return self._epoch(bisect.bisect_right(self.mjds, self.mjds[i]) - 1)
+
+    def closest_before(
+            self,
+            mjd):
+        """
+        *the (mjd, warp) of the last warp taken before ``mjd``, or None*
+        """
+        i = bisect.bisect_left(self.mjds, mjd)
+        if i == 0:
+            return None
+        return self._epoch(i - 1)
+
+    def closest(
+            self,
+            mjd):
+        """
+        *the (mjd, warp) of the warp taken closest to ``mjd`` either side, or None*
+        """
+        i = bisect.bisect_left(self.mjds, mjd)
+        candidates = [j for j in (i - 1, i) if 0 <= j < len(self.mjds)]
+        if not len(candidates):
+            return None
+        return self._epoch(min(candidates, key=lambda j: abs(self.mjds[j] - mjd)))
+
+    def in_range(
+            self,
+            mjdStart=None,
+            mjdEnd=None):
+        """
+        *list of (mjd, warp) of the warps taken between ``mjdStart`` and ``mjdEnd`` (exclusive), in order of epoch. Either end may be None*
+        """
+        lo = 0 if mjdStart is None else bisect.bisect_right(self.mjds, mjdStart)
+        hi = len(self.mjds) if mjdEnd is None else bisect.bisect_left(self.mjds, mjdEnd)
+        return [self._epoch(i) for i in range(lo, hi)]
+
+    def within(
+            self,
+            mjd,
+            window):
+        """
+        *list of (mjd, warp) of the warps taken within ``window`` seconds either side of ``mjd``, in order of epoch*
+        """
+        days = abs(window) / (24. * 60. * 60.)
+        lo = bisect.bisect_left(self.mjds, mjd - days)
+        hi = bisect.bisect_right(self.mjds, mjd + days)
+        return [self._epoch(i) for i in range(lo, hi)]
+
 
 class downloader():
     """
@@ -115,10 +264,19 @@ class downloader():
         return None
 
     # Method Attributes
-    def get(self):
+    def get(
+            self,
+            session=False,
+            timeout=60,
+            concurrentDownloads=10):
         """
         *download the requested jpegs and fits files*
 
+        **Key Arguments:**
+            - ``session`` -- the requests session to request the cutout page with. Default *False* (the shared pooled session)
+            - ``timeout`` -- the timeout in seconds for the cutout page request. Default *60*
+            - ``concurrentDownloads`` -- the number of images to download at once. Default *10*
+
         **Return:**
             - ``fitsPaths`` -- a list of local paths to downloaded fits files
             - ``jpegPaths`` -- a list of local paths to downloaded jpeg files
@@ -130,7 +288,10 @@ class downloader():
         colorPath = []
 
         # REQUEST THE URL FROM STAMP SERVER
-        content, status_code, url = self.get_html_content()
+        content, status_code, url = self.get_html_content(
+            session=session,
+            timeout=timeout
+        )
         if int(status_code) != 200:
             message = 'cound not download the image stamps. The STScI PanSTARRS image server returned HTTP status code %(status_code)s' % locals(
             )
@@ -193,7 +354,8 @@ class downloader():
                 fitsPaths += self._download_images(
                     urls=urls,
                     filenames=fitsFilenames,
-                    downloadDirectory=downloadDirectory
+                    downloadDirectory=downloadDirectory,
+                    concurrentDownloads=concurrentDownloads
                 )
 
                 # DOWNLOAD THE JPEGS FILES?
@@ -207,7 +369,8 @@ class downloader():
                 jpegPaths += self._download_images(
                     urls=urls,
                     filenames=jpegFilenames,
-                    downloadDirectory=downloadDirectory
+                    downloadDirectory=downloadDirectory,
+                    concurrentDownloads=concurrentDownloads
                 )
 
         # IF COLOR STAMPS HAS BEEN REQUESTED
@@ -218,7 +381,8 @@ class downloader():
             colorPath += self._download_images(
                 urls=colorImage["jpeg"],
                 filenames=theseFilenames,
-                downloadDirectory=downloadDirectory
+                downloadDirectory=downloadDirectory,
+                concurrentDownloads=concurrentDownloads
             )
 
         self.log.debug('completed the ``get`` method')
@@ -230,10 +394,16 @@ class downloader():
         return fitsPaths, jpegPaths, colorPath
 
     def get_html_content(
-            self):
+            self,
+            session=False,
+            timeout=60):
         """
         *Build the URL for the stamp request and extract the HTML content*
 
+        **Key Arguments:**
+            - ``session`` -- the requests session to use. Default *False* (the shared pooled session)
+            - ``timeout`` -- the request timeout in seconds. Default *60*
+
         **Return:**
             - ``content`` -- the HTML content of the requested URL
             - ``status_code`` -- the HTTP status code of the request response
@@ -269,7 +439,8 @@ class downloader():
         """
         self.log.debug('starting the ``get_html_content`` method')
 
-        import requests
+        if not session:
+            session = shared_session()
 
         r = self.ra
         d = self.dec
@@ -285,7 +456,7 @@ class downloader():
             jpegSize = 1200
 
         try:
-            response = requests.get(
+            response = session.get(
                 url="http://plpsipp1v.stsci.edu/cgi-bin/ps1cutouts",
                 params={
                     "pos": pos,
@@ -297,9 +468,12 @@ class downloader():
                     "autoscale": "99.500000",
                     "catlist": "",
                 },
+                timeout=timeout
             )
-        except requests.exceptions.RequestException:
-            print('HTTP Request failed')
+        except requests.exceptions.RequestException as e:
+            message = 'HTTP Request to the STScI PanSTARRS image server failed: %(e)s' % locals()
+            self.log.error(message)
+            raise IOError(message)
 
         self.log.debug('completed the ``get_html_content`` method')
         return response.content, response.status_code, response.url
@@ -355,61 +529,42 @@ class downloader():
             - ``colorImage`` -- dictionary of 4 equal length lists. jpeg remote urls, fits remote urls, filters and filenames.
         """
         self.log.debug(
-            'completed the ````parse_html_for_image_urls_and_metadata`` method')
+            'starting the ``parse_html_for_image_urls_and_metadata`` method')
 
         # SETUP THE VARIABLES
-        stackFitsUrls = []
-        warpFitsUrls = []
+        stackFits = {}
+        warpFits = {}
         stackJpegUrls = []
         warpJpegUrls = []
         colorJpegUrl = []
-        stackFitsFilename = []
-        warpFitsFilename = []
-        stackJpegFilename = []
-        warpJpegFilename = []
-        colorJpegFilename = []
         allStacks = {
             "jpegs": [],
             "fits": [],
             "filenames": [],
             "filters": []
         }
-        allWarps = {
-            "jpegs": [],
-            "fits": [],
-            "filenames": []
-        }
         colorImage = {
             "jpeg": [],
             "filename": []
         }
 
-        # USE REGEX TO FIND FITS URLS
-        reFitscutouts = re.compile(
-            r"""<th>(?P<imagetype>\w+)\s+(?P<skycellid>\d+.\d+)\s+(?P<ffilter>[\w\\]+)(\s+(?P<mjd>\d+\.\d+))?(\s<a.*\(warning\)</a>)?<br.*?href="(http:)?//plpsipp1v.*?Display</a>.*?Fits cutout" href="(?P<fiturl>(http:)?//plpsipp1v.*?\.fits)".*?</th>""", re.I)
+        content = content.decode("utf-8")
 
-        thisIter = reFitscutouts.finditer(content.decode("utf-8"))
-        for item in thisIter:
+        # FIND THE FITS URLS, KEYED BY THE DATAPATH OF THE IMAGE ON THE SERVER
+        for item in reFitscutouts.finditer(content):
             imagetype = item.group("imagetype")
-            skycellid = item.group("skycellid")
-            ffilter = item.group("ffilter")
             fiturl = item.group("fiturl")
-            if fiturl[0:5] != "http":
+            if fiturl[0:4] != "http":
                 fiturl = "http:" + fiturl
-            mjd = item.group("mjd")
             if imagetype == "stack":
-                stackFitsUrls.append(fiturl)
+                stackFits[_datapath(fiturl)] = fiturl
             elif imagetype == "warp":
-                warpFitsUrls.append(fiturl)
+                warpFits[_datapath(fiturl)] = fiturl
 
-        # USE REGEX TO FIND JPEG URLS
-        reJpegs = re.compile(
-            r"""<img src="(?P<jpegUrl>(http:)?//plp.*?skycell.*?)\"""", re.I)
-
-        thisIter = reJpegs.finditer(content.decode("utf-8"))
-        for item in thisIter:
+        # FIND THE JPEG URLS
+        for item in reJpegs.finditer(content):
             jpegUrl = item.group("jpegUrl")
-            if jpegUrl[0:5] != "http":
+            if jpegUrl[0:4] != "http":
                 jpegUrl = "http:" + jpegUrl
 
             if "red" in jpegUrl and "blue" in jpegUrl:
@@ -423,114 +578,155 @@ class downloader():
                 self.log.warning(
                     "We are not downloading this jpeg: '%(jpegUrl)s'" % locals())
 
-        # USE REGEX TO FIND FITS METADATA (STACKS)
-        reFitsMeta = re.compile(
-            r'http?.*?\?.*?skycell\.(?P<skycell>\d+\.\d+).*?x=(?P<ra>\d+\.\d+).*?y=(?P<dec>[+|-]?\d+\.\d+).*?size=(?P<pixels>\d+).*?stk\.(?P<ffilter>\w+).*?fits', re.S | re.I)
+        # MATCH EACH STACK JPEG TO ITS FITS AND PARSE THE FITS METADATA
+        stackFilenames = {}
+        for i in stackJpegUrls:
+            datapath = _datapath(i)
+            f = stackFits.get(datapath)
+            if f is None:
+                continue
+            matchObject = reStackMeta.search(f)
+            skycell = matchObject.group("skycell")
+            ra = matchObject.group("ra")
+            dec = matchObject.group("dec")
+            pixels = matchObject.group("pixels")
+            arcsec = str(int(int(pixels) / 4))
+            ffilter = matchObject.group("ffilter")
+            filename = """stack_%(ffilter)s_ra%(ra)s_dec%(dec)s_arcsec%(arcsec)s_skycell%(skycell)s""" % locals(
+            )
+            allStacks["jpegs"].append(i)
+            allStacks["fits"].append(f)
+            allStacks["filenames"].append(filename)
+            allStacks["filters"].append(ffilter)
+            stackFilenames[datapath.split("/")[-1]] = (ffilter, filename)
+
+        # MATCH EACH WARP JPEG TO ITS FITS AND PARSE THE FITS METADATA
+        warps = []
+        for i in warpJpegUrls:
+            f = warpFits.get(_datapath(i))
+            if f is None:
+                continue
+            matchObject = reWarpMeta.search(f)
+            skycell = matchObject.group("skycell")
+            ra = matchObject.group("ra")
+            dec = matchObject.group("dec")
+            pixels = matchObject.group("pixels")
+            arcsec = str(int(int(pixels) / 4))
+            ffilter = matchObject.group("ffilter")
+            mjd = matchObject.group("mjd")
+            warps.append((i, f, ffilter, ra, dec, mjd, arcsec, skycell))
+
+        # INDEX THE WARPS BY EPOCH SO FURTHER EPOCHS CAN BE SELECTED WITHOUT
+        # REQUESTING OR PARSING THE PAGE AGAIN
+        self.warpEpochs = warp_epoch_index(
+            [(float(w[5]), w) for w in warps])
+        allWarps = self.select_warps(
+            mjdStart=self.mjdStart,
+            mjdEnd=self.mjdEnd,
+            window=self.window
+        )
 
-        filterMjd = lambda x: True if not self.mjdStart or (float(
-            x) < self.mjdEnd and float(x) > self.mjdStart) else False
+        # MATCH THE CHANNELS OF THE COLOR IMAGE TO THE STACKS
+        if len(colorJpegUrl):
+            ffilter = ""
+            filename = None
+            for item in reColorMeta.finditer(colorJpegUrl[0]):
+                fits = item.group("datapath").replace(
+                    "%3A", ":").split("/")[-1]
+                if fits in stackFilenames:
+                    b, filename = stackFilenames[fits]
+                    ffilter += b
+            if filename is None:
+                self.log.warning(
+                    "None of the channels of the color image match a stack: '%s'" % (colorJpegUrl[0],))
+            else:
+                filename = "color_" + ffilter + "_" + \
+                    ("_").join(filename.split("_")[2:])
+                colorImage["jpeg"].append(colorJpegUrl[0])
+                colorImage["filename"].append(filename)
 
-        for i in stackJpegUrls:
-            fitsUrl = i.split("&")[0].replace("%3A", ":")
-            for f in stackFitsUrls:
-                if fitsUrl in f:
-                    matchObject = re.search(reFitsMeta, f)
-                    skycell = matchObject.group("skycell")
-                    ra = matchObject.group("ra")
-                    dec = matchObject.group("dec")
-                    pixels = matchObject.group("pixels")
-                    arcsec = str(int(int(pixels) / 4))
-                    ffilter = matchObject.group("ffilter")
-                    filename = """stack_%(ffilter)s_ra%(ra)s_dec%(dec)s_arcsec%(arcsec)s_skycell%(skycell)s""" % locals(
-                    )
-                    allStacks["jpegs"].append(i)
-                    allStacks["fits"].append(f)
-                    allStacks["filenames"].append(filename)
-                    allStacks["filters"].append(ffilter)
-
-        # USE REGEX TO FIND FITS METADATA (WARPS)
-        reFitsMeta = re.compile(
-            r'http?.*?\?.*?skycell\.(?P<skycell>\d+\.\d+).*?x=(?P<ra>\d+\.\d+).*?y=(?P<dec>[+|-]?\d+\.\d+).*?size=(?P<pixels>\d+).*?wrp\.(?P<ffilter>\w+)\.(?P<mjd>\d+\.\d+).*?fits', re.S | re.I)
+        self.log.debug(
+            'completed the ``parse_html_for_image_urls_and_metadata`` method')
+
+        return allStacks, allWarps, colorImage
+
+    def select_warps(
+            self,
+            mjdStart=False,
+            mjdEnd=False,
+            window=False):
+        """
+        *select warps from the last parsed cutout page by epoch*
+
+        Uses the warp epoch index built by ``parse_html_for_image_urls_and_metadata``, so warps for several epochs of the same object (e.g. pre-explosion and peak) can be selected from one request of the cutout page.
+
+        **Key Arguments:**
+            - ``mjdStart`` -- the start of the time-window. If given without ``mjdEnd`` the closest warp after this MJD is selected. Default *False*
+            - ``mjdEnd`` -- the end of the time-window. If given without ``mjdStart`` the closest warp before this MJD is selected. Default *False*
+            - ``window`` -- when selecting the closest warp, the maximum time between the warp and the requested MJD in seconds. Default *False* (no limit)
+
+        **Return:**
+            - ``allWarps`` -- dictionary of 3 equal length lists. jpeg remote urls, fits remote urls and filenames, in order of epoch.
+
+        **Usage:**
+
+        .. code-block:: python 
+
+            content, status_code, url = mydownloader.get_html_content()
+            allStacks, allWarps, colorImage = mydownloader.parse_html_for_image_urls_and_metadata(content=content)
+            preExplosion = mydownloader.select_warps(mjdEnd=58800.)
+            peak = mydownloader.select_warps(mjdStart=58830., window=86400)
+        """
+        self.log.debug('starting the ``select_warps`` method')
+
+        allWarps = {
+            "jpegs": [],
+            "fits": [],
+            "filenames": []
+        }
+
+        warpFilename = lambda ffilter, ra, dec, mjd, arcsec, skycell: """warp_%(ffilter)s_ra%(ra)s_dec%(dec)s_mjd%(mjd)s_arcsec%(arcsec)s_skycell%(skycell)s""" % locals(
+        )
+
+        def add(warp, mjd):
+            i, f, ffilter, ra, dec, _, arcsec, skycell = warp
+            allWarps["jpegs"].append(i)
+            allWarps["fits"].append(f)
+            allWarps["filenames"].append(
+                warpFilename(ffilter, ra, dec, mjd, arcsec, skycell))
 
         # GIVEN A RANGE IN MJDs OR NO MJDs
-        if (self.mjdStart and self.mjdEnd) or not (self.mjdStart or self.mjdEnd):
-            for i in warpJpegUrls:
-                fitsUrl = i.split("&")[0].replace("%3A", ":")
-                for f in warpFitsUrls:
-                    if fitsUrl in f:
-                        matchObject = re.search(reFitsMeta, f)
-                        skycell = matchObject.group("skycell")
-                        ra = matchObject.group("ra")
-                        dec = matchObject.group("dec")
-                        pixels = matchObject.group("pixels")
-                        arcsec = str(int(int(pixels) / 4))
-                        ffilter = matchObject.group("ffilter")
-                        mjd = matchObject.group("mjd")
-                        if not filterMjd(mjd):
-                            continue
-                        filename = """warp_%(ffilter)s_ra%(ra)s_dec%(dec)s_mjd%(mjd)s_arcsec%(arcsec)s_skycell%(skycell)s""" % locals(
-                        )
-                        allWarps["jpegs"].append(i)
-                        allWarps["fits"].append(f)
-                        allWarps["filenames"].append(filename)
-        elif self.mjdStart:
+        if (mjdStart and mjdEnd) or not (mjdStart or mjdEnd):
+            if mjdStart:
+                selected = self.warpEpochs.in_range(mjdStart, mjdEnd)
+            else:
+                selected = self.warpEpochs.in_range()
+            for mjd, warp in selected:
+                add(warp, warp[5])
+        elif mjdStart:
+            closest = self.warpEpochs.closest_after(mjdStart)
             closestMjd = 99999999.
-            for i in warpJpegUrls:
-                fitsUrl = i.split("&")[0].replace("%3A", ":")
-                for f in warpFitsUrls:
-                    if fitsUrl in f:
-                        matchObject = re.search(reFitsMeta, f)
-                        skycell = matchObject.group("skycell")
-                        ra = matchObject.group("ra")
-                        dec = matchObject.group("dec")
-                        pixels = matchObject.group("pixels")
-                        arcsec = str(int(int(pixels) / 4))
-                        ffilter = matchObject.group("ffilter")
-                        mjd = float(matchObject.group("mjd"))
-                        if not mjd > self.mjdStart or mjd > closestMjd:
-                            continue
-                        closestMjd = mjd
-                        filename = """warp_%(ffilter)s_ra%(ra)s_dec%(dec)s_mjd%(mjd)s_arcsec%(arcsec)s_skycell%(skycell)s""" % locals(
-                        )
-                        allWarps["jpegs"] = [i]
-                        allWarps["fits"] = [f]
-                        allWarps["filenames"] = [filename]
-            mjdDiff = (closestMjd - self.mjdStart) * 24 * 60 * 60
-            window = self.window
+            if closest is not None:
+                closestMjd, warp = closest
+                add(warp, closestMjd)
+            mjdDiff = (closestMjd - mjdStart) * 24 * 60 * 60
             if window:
-                window = abs(self.window)
+                window = abs(window)
                 if mjdDiff > window:
                     print ("No warp image was found within %(window)s sec after requested MJD" % locals())
                     allWarps["jpegs"] = []
                     allWarps["fits"] = []
                     allWarps["filenames"] = []
             print ("The closest selected warp was taken %(mjdDiff)0.1f sec after the requested MJD" % locals())
-        elif self.mjdEnd:
+        elif mjdEnd:
+            closest = self.warpEpochs.closest_before(mjdEnd)
             closestMjd = 0.
-            for i in warpJpegUrls:
-                fitsUrl = i.split("&")[0].replace("%3A", ":")
-                for f in warpFitsUrls:
-                    if fitsUrl in f:
-                        matchObject = re.search(reFitsMeta, f)
-                        skycell = matchObject.group("skycell")
-                        ra = matchObject.group("ra")
-                        dec = matchObject.group("dec")
-                        pixels = matchObject.group("pixels")
-                        arcsec = str(int(int(pixels) / 4))
-                        ffilter = matchObject.group("ffilter")
-                        mjd = float(matchObject.group("mjd"))
-                        if not mjd < self.mjdEnd or mjd < closestMjd:
-                            continue
-                        closestMjd = mjd
-                        filename = """warp_%(ffilter)s_ra%(ra)s_dec%(dec)s_mjd%(mjd)s_arcsec%(arcsec)s_skycell%(skycell)s""" % locals(
-                        )
-                        allWarps["jpegs"] = [i]
-                        allWarps["fits"] = [f]
-                        allWarps["filenames"] = [filename]
-            mjdDiff = (self.mjdEnd - closestMjd) * 24 * 60 * 60
-            window = self.window
+            if closest is not None:
+                closestMjd, warp = closest
+                add(warp, closestMjd)
+            mjdDiff = (mjdEnd - closestMjd) * 24 * 60 * 60
             if window:
-                window = abs(self.window)
+                window = abs(window)
                 if mjdDiff > window:
                     print ("No warp image was found within %(window)s sec before requested MJD" % locals())
                     allWarps["jpegs"] = []
@@ -538,35 +734,15 @@ class downloader():
                     allWarps["filenames"] = []
             print ("The closest selected warp was taken %(mjdDiff)0.1f sec before the requested MJD" % locals())
 
-        # USE REGEX TO FIND COLOR IMAGE METADATA
-        if len(colorJpegUrl):
-            reColorMeta = re.compile(
-                r'(?P<color>\w+)=(?P<datapath>/data.*?)&', re.S | re.I)
-
-            thisIter = reColorMeta.finditer(colorJpegUrl[0])
-            ffilter = ""
-            for item in thisIter:
-                fits = item.group("datapath").replace(
-                    "%3A", ":").split("/")[-1]
-                for j, f, n, b in zip(allStacks["jpegs"], allStacks["fits"],  allStacks["filenames"], allStacks["filters"]):
-                    if fits in f:
-                        ffilter += b
-                        filename = n
-            filename = "color_" + ffilter + "_" + \
-                ("_").join(filename.split("_")[2:])
-            colorImage["jpeg"].append(colorJpegUrl[0])
-            colorImage["filename"].append(filename)
-
-        self.log.debug(
-            'completed the ``parse_html_for_image_urls_and_metadata`` method')
-
-        return allStacks, allWarps, colorImage
+        self.log.debug('completed the ``select_warps`` method')
+        return allWarps
 
     def _download_images(
         self,
         urls=[],
         filenames=[],
-        downloadDirectory=False
+        downloadDirectory=False,
+        concurrentDownloads=10
     ):
         """
         *download images*
@@ -575,6 +751,7 @@ class downloader():
             - ``urls`` -- list of the remote URLs to download
             - ``filenames`` -- list filenames to rename the downloads as
             - ``downloadDirectory`` -- path to the download directory
+            - ``concurrentDownloads`` -- the number of images to download at once. Default *10*
 
         **Return:**
             - ``localUrls`` -- list of the paths to local image files
@@ -590,7 +767,7 @@ class downloader():
             log=self.log,
             timeStamp=0,
             timeout=180,
-            concurrentDownloads=10,
+            concurrentDownloads=concurrentDownloads,
             resetFilename=filenames,
             credentials=False,  # { 'username' : "...", "password", "..." }
             longTime=False,
@@ -599,3 +776,65 @@ class downloader():
 
         self.log.debug('completed the ``_download_images`` method')
         return localUrls
+
+
+def batch_get(
+        log,
+        positions,
+        concurrentDownloads=10,
+        timeout=60,
+        **kwargs):
+    """
+    *download the stamps for many positions at once*
+
+    The cutout pages for ``concurrentDownloads`` positions at a time are requested through the shared pooled session. The images for each position are then downloaded one at a time (outside the shared session), so no more than ``concurrentDownloads`` connections are open to the stamp server at once.
+
+    **Key Arguments:**
+        - ``log`` -- logger
+        - ``positions`` -- list of (ra, dec) tuples
+        - ``concurrentDownloads`` -- the number of positions to request at once. Default *10*
+        - ``timeout`` -- the timeout in seconds for each cutout page request. Default *60*
+        - ``kwargs`` -- any other ``downloader`` arguments, used for every position
+
+    **Return:**
+        - ``results`` -- a list with one entry per position, either the ``(fitsPaths, jpegPaths, colorPath)`` tuple returned by ``downloader.get`` or the exception raised for that position
+
+    **Usage:**
+
+        .. code-block:: python 
+
+            from downloader import batch_get
+            results = batch_get(
+                log=log,
+                positions=[("70.60271", "-21.72433"), ("2.093337", "33.089009")],
+                fits=False,
+                jpeg=True,
+                arcsecSize=75,
+                filterSet='gri',
+                color=True,
+                singleFilters=False,
+                imageType="stack"
+            )
+    """
+    log.debug('starting the ``batch_get`` function')
+
+    session = shared_session(poolSize=concurrentDownloads)
+
+    def get_one(position):
+        ra, dec = position
+        try:
+            return downloader(log=log, ra=ra, dec=dec, **kwargs).get(
+                session=session,
+                timeout=timeout,
+                # the positions are already downloaded concurrently
+                concurrentDownloads=1
+            )
+        except Exception as e:
+            log.error("could not download the stamps at %(ra)s %(dec)s: %(e)s" % locals())
+            return e
+
+    with ThreadPoolExecutor(max_workers=concurrentDownloads) as pool:
+        results = list(pool.map(get_one, positions))
+
+    log.debug('completed the ``batch_get`` function')
+    return results
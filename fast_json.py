@@ -0,0 +1,28 @@
+import re
+
+# decode json with the fastest library installed: orjson, then ujson, then
+# the standard library.  All three accept either str or bytes.
+try:
+    from orjson import loads
+except ImportError:
+    try:
+        from ujson import loads
+    except ImportError:
+        from json import loads
+
+# objectId as the first key of a lasair alert, e.g. {"objectId": "ZTF20acufbmq", ...}.
+# Anchored to the opening brace, so an objectId nested further into the alert
+# can never match.
+_objectId_re = re.compile(rb'\A\s*\{\s*"objectId"\s*:\s*"([^"\\]*)"')
+
+def load(f):
+    # f should be opened in binary mode so the text is never decoded twice
+    return loads(f.read())
+
+def extract_objectId(msg):
+    # pull the objectId out of a raw kafka message without decoding the whole
+    # alert, falling back to a full decode when objectId is not the first key
+    match = _objectId_re.match(msg)
+    if match != None:
+        return match.group(1).decode("utf-8")
+    return loads(msg)['objectId']
@@ -1,12 +1,21 @@
-from confluent_kafka import Consumer, KafkaError, Message
+import logging
+from confluent_kafka import Consumer, KafkaError, KafkaException, Message, TopicPartition
 
 class msgConsumer():
-    def __init__(self, kafka_server, group_id):
+    def __init__(self, kafka_server, group_id, auto_commit=True, max_poll_interval_ms=300000):
         self.group_id = group_id
+        self.log = logging.getLogger("lasair-consumer-logger")
 
+        # with auto_commit=False offsets only advance when commit() is called,
+        # so alerts consumed before a crash are read again on the next run.
+        # max_poll_interval_ms has to be longer than the processing done
+        # between polls, or the consumer is dropped from its group and can no
+        # longer commit.
         conf = {
             'bootstrap.servers': kafka_server,
             'group.id': self.group_id,
+            'enable.auto.commit': auto_commit,
+            'max.poll.interval.ms': max_poll_interval_ms,
             'default.topic.config': {'auto.offset.reset': 'smallest'}
         }
         self.streamReader = Consumer(conf)
@@ -26,9 +35,54 @@ class msgConsumer():
             msg = self.streamReader.poll(timeout=30)
             if(msg != None):
                 return msg.value()
-        except:
+        except KafkaException:
+            self.log.exception("Error polling kafka")
             return None
 
+    def consume_batch(self, max_messages=100, timeout=5):
+        # returns up to max_messages messages, or None if nothing arrived
+        # within timeout seconds.  Returns as soon as the first message
+        # arrives, along with any others already fetched, rather than waiting
+        # for max_messages or the full timeout.
+        try:
+            msg = self.streamReader.poll(timeout=timeout)
+            if msg == None:
+                return None
+            msgs = [msg]
+            if max_messages > 1:
+                msgs += self.streamReader.consume(num_messages=max_messages-1, timeout=0)
+        except KafkaException:
+            self.log.exception("Error consuming from kafka")
+            return None
+
+        batch = []
+        for msg in msgs:
+            error = msg.error()
+            if error != None:
+                if error.code() != KafkaError._PARTITION_EOF:
+                    self.log.error("Kafka error: %s" % (error))
+                continue
+            batch.append(msg)
+        return batch
+
+    def commit(self, offsets):
+        # synchronously commit offsets, a list of (topic, partition, offset)
+        # of the next message to read from each partition.  Returns True if
+        # every offset was committed.
+        if len(offsets) == 0:
+            return True
+        try:
+            committed = self.streamReader.commit(offsets=[TopicPartition(topic, partition, offset) for topic, partition, offset in offsets],
+                                                 asynchronous=False)
+        except KafkaException:
+            self.log.exception("Error committing kafka offsets")
+            return False
+        ok = True
+        for tp in committed:
+            if tp.error != None:
+                self.log.error("Error committing kafka offset for %s [%d]: %s" % (tp.topic, tp.partition, tp.error))
+                ok = False
+        return ok
+
     def close(self):
         self.streamReader.close()
-
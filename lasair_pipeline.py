@@ -0,0 +1,124 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+# marks the end of the stream as it is passed from one stage to the next
+_STOP = object()
+
+class lasair_pipeline:
+    """
+    Streaming alternative to draining the whole kafka topic before processing.
+
+    Each objectId read from the topic is passed straight through the
+    download -> parse -> plot -> stamp -> upload stages.  Every stage runs in
+    its own thread and the stages are joined by bounded queues, so a slow stage
+    blocks the stages upstream of it rather than letting work pile up in memory.
+    """
+
+    def __init__(self, lasair_zoo, url, data_dir, queue_size=10):
+        self.lasair_zoo = lasair_zoo
+        self.url = url
+        self.data_dir = data_dir
+        self.queue_size = queue_size
+        self.log = logging.getLogger("lasair-pipeline-logger")
+
+        # panoptes connection, made lazily from the upload thread
+        self.project = None
+        self.subject_set = None
+        self.uploaded = []
+        self.failed = {}
+
+    def run(self, group_id, topic, project_id, workflow_id, subject_set_id=None, records_limit=None):
+        self.project_id = project_id
+        self.workflow_id = workflow_id
+        self.subject_set_id = subject_set_id
+
+        stages = [self.download, self.parse, self.plot, self.stamp, self.upload]
+        queues = [queue.Queue(maxsize=self.queue_size) for stage in stages]
+        queues.append(None)
+
+        threads = []
+        for i, stage in enumerate(stages):
+            t = threading.Thread(target=self._run_stage,
+                                 args=(stage, queues[i], queues[i+1]),
+                                 name=stage.__name__)
+            t.start()
+            threads.append(t)
+
+        start = time.time()
+        n_objects = 0
+        try:
+            for objectId in self.lasair_zoo.stream_lasair_topic(group_id, topic):
+                queues[0].put(objectId)
+                n_objects += 1
+                if records_limit != None and n_objects >= records_limit:
+                    break
+        finally:
+            queues[0].put(_STOP)
+            for t in threads:
+                t.join()
+
+        print('======= %d objects, %d uploaded in %.1f seconds =========' % (n_objects, len(self.uploaded), time.time()-start))
+
+        # hold the kafka offsets back for objects that failed to download or
+        # upload, so they are tried again on the next run, which carries on
+        # with the same subject set.  Objects that failed in the other stages
+        # (or were never taken from the stream) are skipped.
+        failed = self.failed.get('download', []) + [proto_subject['metadata']['objectId'] for proto_subject in self.failed.get('upload', [])]
+        if self.lasair_zoo.commit_lasair_topic(self.uploaded, failed):
+            if self.subject_set != None:
+                self.lasair_zoo.finish_subject_set(self.subject_set)
+        else:
+            print('%d of %d objects uploaded, kafka offsets not all committed' % (len(self.uploaded), n_objects))
+        return self.uploaded
+
+    def _run_stage(self, stage, in_queue, out_queue):
+        while 1:
+            item = in_queue.get()
+            if item is _STOP:
+                if out_queue != None:
+                    out_queue.put(_STOP)
+                break
+            try:
+                item = stage(item)
+            except Exception:
+                self.log.exception("Error in pipeline stage %s" % (stage.__name__))
+                self.failed.setdefault(stage.__name__, []).append(item)
+                continue
+            # stages return None to drop an object from the rest of the pipeline
+            if item != None and out_queue != None:
+                out_queue.put(item)
+
+    def _dirpath(self):
+        return os.path.join(self.data_dir, time.strftime("%m-%d-%Y", time.gmtime()))
+
+    def download(self, objectId):
+        # stop here rather than carry on with an older cached json, or none
+        if not self.lasair_zoo.wget_objectdata(objectId, self.url, self.data_dir):
+            raise IOError("Failed to download object data for object: " + objectId)
+        return objectId
+
+    def parse(self, objectId):
+        return self.lasair_zoo.parse_object_data(objectId, self.data_dir)
+
+    def plot(self, lasair_zobject):
+        light_curve = self.lasair_zoo.plot_lightcurve(lasair_zobject, self._dirpath())
+        return lasair_zobject, light_curve
+
+    def stamp(self, item):
+        lasair_zobject, light_curve = item
+        panstamps = self.lasair_zoo.build_stamp(lasair_zobject, self._dirpath())
+        return self.lasair_zoo.make_proto_subject(lasair_zobject, light_curve, panstamps)
+
+    def upload(self, proto_subject):
+        if self.subject_set == None:
+            self.project, self.subject_set = self.lasair_zoo.connect_subject_set(self.project_id,
+                                                                                self.workflow_id,
+                                                                                self.subject_set_id)
+        objectId = proto_subject['metadata']['objectId']
+        results = self.lasair_zoo.upload_subjects(self.project, self.subject_set, [proto_subject])
+        if not results[objectId]:
+            raise IOError("Failed to upload subject for object: " + objectId)
+        self.uploaded.append(objectId)
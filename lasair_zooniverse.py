@@ -1,23 +1,37 @@
+import io
 import os
 import time
-import json
-import wget
+import shutil
+import fast_json
 import lasair_consumer
 import logging
-import matplotlib
+import requests
 
+from concurrent.futures import ThreadPoolExecutor
+import crosshairs
+import lightcurve_renderer
 from lasair_consumer import msgConsumer
-from PIL import Image, ImageDraw
+from object_cache import object_cache
+from stamp_cache import stamp_cache
+from upload_journal import upload_journal
+from urllib3.util.retry import Retry
 from lasair_zooniverse_base import lasair_zooniverse_base_class
 
 # 3rd party imports
-import matplotlib.pyplot as plt
 import numpy as np
 from panoptes_client import Panoptes, Project, SubjectSet, Subject, Workflow
 from panstamps import __version__
 from panstamps import cl_utils
 from panstamps import utKit
-from panstamps.downloader import downloader
+from downloader import downloader, batch_get
+
+# columns of lasair_object.Detections, one row per candidate.  error is NaN
+# for non-detections, where mag holds the limiting magnitude.
+detection_dtype = np.dtype([('mjd', 'f8'),
+                            ('mag', 'f8'),
+                            ('error', 'f8'),
+                            ('fid', 'i4'),
+                            ('detect_flag', '?')])
 
 class lasair_object:
 
@@ -30,60 +44,209 @@ class lasair_object:
         self.decmean = dec
         self.stamp = stamp
         self.lightcurve_plot = lightcurve_plot
-        self.Detections = []
+        self.Detections = np.empty(0, dtype=detection_dtype)
 
     def __str__(self):
       print (self.objectId, self.ramean, self.decmean)
 
+    def select(self, fid, detect_flag):
+        # rows of Detections for one filter (1 = g, 2 = r), either detections or limits
+        mask = (self.Detections['fid'] == fid) & (self.Detections['detect_flag'] == detect_flag)
+        return self.Detections[mask]
+
 
 def get_objectId(msg):
-    msgString = msg.decode("utf-8")
-    msgDict = json.loads(msgString)
-    objectname = msgDict['objectId']
+    objectname = fast_json.extract_objectId(msg)
     return objectname                
 
 
 class lasair_zooniverse_class(lasair_zooniverse_base_class):
 
-    def __init__(self, kafka_server, ENDPOINT):
+    def __init__(self, kafka_server, ENDPOINT, download_workers=8, download_timeout=30, download_retries=3, object_cache_dir=None, render_cache_dir=None,
+                 stamp_cache_dir=None, stamp_cache_max_mb=1000, stamp_cache_tolerance=1.0, stamp_cache_match_radius=1.0,
+                 stamp_in_memory=False, upload_journal_path=None, max_poll_interval_ms=300000, render_cache_max_age_days=30,
+                 max_attempts=3, subject_set_max_age_days=7):
         self.kafka_server = kafka_server
+        self.max_poll_interval_ms = max_poll_interval_ms
+        # runs an object may fail to download or upload before it is skipped
+        self.max_attempts = max_attempts
         self.ENDPOINT = ENDPOINT
         self.log = logging.getLogger("lasair-zooniverse-logger")
 
+        # settings for fetching the lasair object json
+        self.download_workers = download_workers
+        self.download_timeout = download_timeout
+        self.download_retries = download_retries
+        self.session = None
+        self.renderer = None
+        self.render_cache_dir = render_cache_dir
+        self.render_cache_max_age_days = render_cache_max_age_days
+
+        # keep the object json in a persistent cache rather than re-downloading
+        # it into a new dated directory every day
+        self.object_cache = None
+        if object_cache_dir != None:
+            self.object_cache = object_cache(object_cache_dir)
+
+        # PS1 stacks never change, so keep the stamps for reuse by repeat objects
+        self.stamp_cache = None
+        if stamp_cache_dir != None:
+            self.stamp_cache = stamp_cache(stamp_cache_dir, stamp_cache_max_mb*1024*1024, stamp_cache_tolerance, stamp_cache_match_radius)
+
+        # keep the annotated stamps in memory and upload them from there
+        # rather than writing them back to disk
+        self.stamp_in_memory = stamp_in_memory
+
+        # record of the subjects uploaded so far, so a failed upload can be
+        # resumed by the next run
+        self.upload_journal = None
+        if upload_journal_path != None:
+            self.upload_journal = upload_journal(upload_journal_path)
+        # an unfinished subject set is only carried on with for this long
+        self.subject_set_max_age_days = subject_set_max_age_days
+
+
+    def query_lasair_topic(self, group_id, topic, auto_commit=False):
 
-    def query_lasair_topic(self, group_id, topic):
-
-        c = msgConsumer(self.kafka_server, group_id)
-        c.subscribe(topic)
         start = time.time()
-        objectIds = []
-
-        while 1:
-            msg = c.poll()
-            print(msg)
-            if msg == None:
-                break
-            else:
-                objectname = get_objectId(msg)
-                objectIds.append(objectname)
+        objectIds = list(self.stream_lasair_topic(group_id, topic, auto_commit=auto_commit))
         print('======= %.1f seconds =========' % ((time.time()-start)))
         print('poll done')
 
-        #remove duplicates from the list
-        objectIds = list(set(objectIds))
-
         return objectIds
 
+    def stream_lasair_topic(self, group_id, topic, batch_size=100, timeout=5, first_timeout=30, auto_commit=False):
+        # yield each new objectId as soon as its alert arrives, stopping once
+        # the topic has been quiet for timeout seconds.  The first batch waits
+        # longer to give the consumer group time to join.
+        # Unless auto_commit is set, offsets are not committed until
+        # commit_lasair_topic is called.
+        self.consumer = msgConsumer(self.kafka_server, group_id, auto_commit, self.max_poll_interval_ms)
+        self.consumer.subscribe(topic)
+        # (topic, partition, offset, objectId) of every alert consumed
+        self.consumed = []
+        seen = set()
+
+        msgs = self.consumer.consume_batch(batch_size, first_timeout)
+        while msgs != None:
+            # record the whole batch before yielding any of it, so alerts that
+            # are never yielded are not committed either
+            batch = [(msg, get_objectId(msg.value())) for msg in msgs]
+            for msg, objectname in batch:
+                self.consumed.append((msg.topic(), msg.partition(), msg.offset(), objectname))
+            for msg, objectname in batch:
+                print(msg.value())
+                #skip duplicate alerts for the same object
+                if objectname in seen:
+                    continue
+                seen.add(objectname)
+                yield objectname
+            msgs = self.consumer.consume_batch(batch_size, timeout)
+
+    def commit_lasair_topic(self, uploaded, failed=()):
+        # call once the objects from stream_lasair_topic have been processed,
+        # with the objectIds that were uploaded and those whose download or
+        # upload failed.  Those failures may well succeed next time, so in
+        # each partition the offset only advances up to the first alert for a
+        # failed object, and it is read again on the next run.  Once an object
+        # has failed max_attempts runs (counted in the upload journal, so
+        # without one it is retried every run) it is given up on.  Every
+        # other alert is committed, including those for
+        # objects left out by RECORDS_LIMIT or that can never make a subject,
+        # e.g. outside the PS1 footprint, which are logged as skipped.
+        # Returns True if every alert consumed has been committed.
+        uploaded = set(uploaded)
+        retry = set(failed) - uploaded
+        if self.upload_journal != None and len(retry) > 0:
+            for objectId, attempts in self.upload_journal.failed(retry).items():
+                if attempts >= self.max_attempts:
+                    self.log.warning("Giving up on object %s after %d failed runs" % (objectId, attempts))
+                    retry.discard(objectId)
+
+        skipped = set(objectId for topic, partition, offset, objectId in self.consumed) - uploaded - retry
+        if len(skipped) > 0:
+            self.log.warning("Skipping %d objects that were not uploaded: %s" % (len(skipped), ', '.join(sorted(skipped))))
+
+        offsets = {}
+        held = set()
+        for topic, partition, offset, objectId in sorted(self.consumed):
+            if (topic, partition) in held:
+                continue
+            if objectId in retry:
+                held.add((topic, partition))
+            else:
+                offsets[(topic, partition)] = offset + 1
+
+        committed = self.consumer.commit([(topic, partition, offset) for (topic, partition), offset in offsets.items()])
+        self.consumer.close()
+        if len(retry) > 0:
+            print('kafka offsets held back in %d partitions to retry %d objects' % (len(held), len(retry)))
+        return committed and len(retry) == 0
+
+    def close_lasair_topic(self):
+        # with auto_commit the offsets are committed as the alerts are read
+        self.consumer.close()
+
+    def http_session(self):
+        # one keep-alive session shared by all downloads, with a connection
+        # pool per download worker and retries with exponential backoff
+        if self.session == None:
+            retry = Retry(total=self.download_retries,
+                          backoff_factor=1,
+                          status_forcelist=[429, 500, 502, 503, 504])
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=self.download_workers,
+                                                    max_retries=retry)
+            self.session = requests.Session()
+            self.session.mount('http://', adapter)
+            self.session.mount('https://', adapter)
+        return self.session
+
     def wget_objectdata(self, objectId, url, data_dir):
+        dirpath = os.path.join(data_dir, time.strftime("%m-%d-%Y", time.gmtime()))
+        os.makedirs(dirpath, exist_ok=True)
+        return self._fetch_objectdata(objectId, url, dirpath)
+
+    def fetch_objectdata(self, objectIds, url, data_dir):
+        # download the json for all objectIds concurrently, returning the
+        # objectIds that were fetched successfully
+        dirpath = os.path.join(data_dir, time.strftime("%m-%d-%Y", time.gmtime()))
+        os.makedirs(dirpath, exist_ok=True)
+        print(dirpath)
+
+        # create the shared session before the threads, so they all use it
+        self.http_session()
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.download_workers) as pool:
+            fetched = list(pool.map(lambda objectId: self._fetch_objectdata(objectId, url, dirpath), objectIds))
+        print('======= fetched %d objects in %.1f seconds =========' % (sum(fetched), time.time()-start))
+
+        return [objectId for objectId, ok in zip(objectIds, fetched) if ok]
+
+    def _fetch_objectdata(self, objectId, url, dirpath):
         try:
-            url = url % (objectId)
-            dirpath = os.path.join(data_dir, time.strftime("%m-%d-%Y", time.gmtime()))
-            if not os.path.exists(dirpath):
-                os.makedirs(dirpath)
-            print(dirpath)
-            wget.download(url, os.path.join(dirpath, objectId + '.json'))
+            headers = {}
+            if self.object_cache != None:
+                headers = self.object_cache.conditional_headers(objectId)
+            response = self.http_session().get(url % (objectId), headers=headers, timeout=self.download_timeout)
+            # the cached copy is still up to date
+            if response.status_code == 304:
+                return True
+            response.raise_for_status()
+            if self.object_cache != None:
+                self.object_cache.update(objectId, response)
+                return True
+            # write to a temporary file first so an interrupted download never
+            # leaves a truncated json behind
+            path = os.path.join(dirpath, objectId + '.json')
+            with open(path + '.part', 'wb') as f:
+                f.write(response.content)
+            os.replace(path + '.part', path)
+            return True
         except Exception:
-            self.log.exception("Error in wget for object: " + objectId)
+            self.log.exception("Error in download for object: " + objectId)
+            return False
 
     def produce_proto_subject(self, unique_id, data_dir):
         # produce plots and gather metadata for each subject to be created
@@ -91,29 +254,149 @@ class lasair_zooniverse_class(lasair_zooniverse_base_class):
         if(lasair_zobject != None):
             try:
                 light_curve, panstamps = self.build_plots(lasair_zobject, data_dir)
-                metadata = {'objectId': lasair_zobject.objectId, 'ramean': lasair_zobject.ramean, 'decmean': lasair_zobject.decmean }
-
-                proto_subject = {}
-                proto_subject['location_lc'] = light_curve
-                proto_subject['location_ps'] = panstamps
-                proto_subject['metadata'] = metadata
-
-                return (proto_subject)
+                return self.make_proto_subject(lasair_zobject, light_curve, panstamps)
             except Exception:
                 self.log.exception("Error in produce_proto_subject for object: " + unique_id)
         return None
 
-    def create_subjects_and_link_to_project(self, proto_subjects, project_id, workflow_id, subject_set_id):
+    def produce_proto_subjects(self, objectIds, data_dir, processes=None):
+        # like produce_proto_subject for a whole batch of objects, rendering
+        # the lightcurves in parallel across a pool of processes and fetching
+        # the stamps concurrently
+        dirpath = os.path.join(data_dir, time.strftime("%m-%d-%Y", time.gmtime()))
+        lasair_zobjects = [self.parse_object_data(objectId, data_dir) for objectId in objectIds]
+        lasair_zobjects = [lo for lo in lasair_zobjects if lo != None]
 
-        
-        try:
-            USERNAME = os.getenv('PANOPTES_USERNAME') 
-            PASSWORD = os.getenv('PANOPTES_PASSWORD')  
-            Panoptes.connect(username=USERNAME, password=PASSWORD, endpoint=self.ENDPOINT)
-            
-            project = Project.find(project_id)
-            workflow = Workflow().find(workflow_id)
+        paths = [os.path.join(dirpath, "%s_light_curve.jpeg"%(lo.objectId)) for lo in lasair_zobjects]
+        light_curves = lightcurve_renderer.render_lightcurves(lasair_zobjects, paths, processes, self.render_cache_dir, self.render_cache_max_age_days)
+
+        # fetch the stamps for every object at once, then annotate them as one batch
+        colorPaths = self.gather_metadata_batch([(lo.ramean, lo.decmean) for lo in lasair_zobjects], dirpath)
+        stamps = self.build_stamps(lasair_zobjects, colorPaths)
+
+        proto_subjects = []
+        for lasair_zobject, light_curve, panstamps in zip(lasair_zobjects, light_curves, stamps):
+            if light_curve == None or panstamps == None:
+                continue
+            try:
+                proto_subjects.append(self.make_proto_subject(lasair_zobject, light_curve, panstamps))
+            except Exception:
+                self.log.exception("Error in produce_proto_subjects for object: " + lasair_zobject.objectId)
+        return proto_subjects
+
+    def make_proto_subject(self, lasair_zobject, light_curve, panstamps):
+        metadata = {'objectId': lasair_zobject.objectId, 'ramean': lasair_zobject.ramean, 'decmean': lasair_zobject.decmean }
+
+        proto_subject = {}
+        proto_subject['location_lc'] = light_curve
+        proto_subject['location_ps'] = panstamps
+        proto_subject['metadata'] = metadata
+
+        return (proto_subject)
 
+    def create_subjects_and_link_to_project(self, proto_subjects, project_id, workflow_id, subject_set_id, batch_size=100):
+        # upload the subjects and link them to the subject set, returning the
+        # subject set and the objectIds of the subjects that made it.  Call
+        # finish_subject_set once nothing more needs adding to the subject set.
+        try:
+            project, subject_set = self.connect_subject_set(project_id, workflow_id, subject_set_id)
+        except Exception:
+            self.log.exception("Error in create_subjects_and_link_to_project ")
+            return None, []
+
+        results = self.upload_subjects(project, subject_set, proto_subjects, batch_size)
+        return subject_set, [objectId for objectId, ok in results.items() if ok]
+
+    def upload_subjects(self, project, subject_set, proto_subjects, batch_size=100):
+        # save the subjects concurrently with the panoptes client's pool of
+        # upload threads, linking each batch to the subject set once it is
+        # saved.  Objects the upload journal shows were already uploaded to
+        # this subject set are not uploaded again.  Returns {objectId: True if
+        # uploaded and linked, else False}.
+        results = {}
+        for start in range(0, len(proto_subjects), batch_size):
+            saving = []
+            saved = []
+            with Subject.async_saves():
+                for proto_subject in proto_subjects[start:start + batch_size]:
+                    objectId = proto_subject['metadata']['objectId']
+                    journaled = None
+                    if self.upload_journal != None:
+                        journaled = self.upload_journal.get(objectId, subject_set.id)
+                    if journaled != None and journaled[0] == 'linked':
+                        results[objectId] = True
+                        continue
+                    if journaled != None:
+                        # saved by an earlier run that stopped before linking it
+                        saved.append((objectId, journaled[1]))
+                        continue
+                    try:
+                        subject = self.build_subject(project, proto_subject)
+                        subject.save()
+                        saving.append((objectId, subject))
+                    except Exception:
+                        self.log.exception("Error saving subject for object: " + objectId)
+                        results[objectId] = False
+
+            # leaving the with block waits for all of the saves to finish
+            for objectId, subject in saving:
+                try:
+                    results[objectId] = subject.async_save_result
+                except Exception:
+                    self.log.exception("Error saving subject for object: " + objectId)
+                    results[objectId] = False
+                if results[objectId]:
+                    saved.append((objectId, subject.id))
+            if self.upload_journal != None:
+                self.upload_journal.saved(subject_set.id, saved)
+
+            if len(saved) > 0:
+                try:
+                    subject_set.add([subject_id for objectId, subject_id in saved])
+                    for objectId, subject_id in saved:
+                        results[objectId] = True
+                    if self.upload_journal != None:
+                        self.upload_journal.linked(subject_set.id, [objectId for objectId, subject_id in saved])
+                except Exception:
+                    self.log.exception("Error linking subjects to subject set " + str(subject_set.id))
+                    for objectId, subject_id in saved:
+                        results[objectId] = False
+
+        print("Uploaded %d of %d subjects" % (sum(results.values()), len(proto_subjects)))
+        return results
+
+    def finish_subject_set(self, subject_set):
+        # every subject is in the subject set and every alert committed, so
+        # the next run starts a new one
+        if self.upload_journal != None:
+            self.upload_journal.finish(subject_set.id)
+
+    def connect_subject_set(self, project_id, workflow_id, subject_set_id):
+        # log in to panoptes and find (or create) the subject set linked to the workflow
+        # N.B. the panoptes client is thread local, so call this from the thread that uploads
+        USERNAME = os.getenv('PANOPTES_USERNAME') 
+        PASSWORD = os.getenv('PANOPTES_PASSWORD')  
+        Panoptes.connect(username=USERNAME, password=PASSWORD, endpoint=self.ENDPOINT)
+        
+        project = Project.find(project_id)
+        workflow = Workflow().find(workflow_id)
+
+        # carry on with the subject set of a run that did not finish, unless
+        # it is too old or can no longer be used, e.g. it was deleted
+        subject_set = None
+        if subject_set_id == None and self.upload_journal != None:
+            open_id = self.upload_journal.open_subject_set(project_id, workflow_id, self.subject_set_max_age_days)
+            if open_id != None:
+                try:
+                    subject_set = SubjectSet().find(open_id)
+                    workflow.add_subject_sets(subject_set)
+                    print("Resuming upload to subject set " + open_id)
+                except Exception:
+                    self.log.exception("Cannot resume subject set " + open_id + ", starting a new one")
+                    self.upload_journal.finish(open_id)
+                    subject_set = None
+
+        if subject_set == None:
             if subject_set_id == None:
                 subject_set = SubjectSet()
                 ts = time.gmtime()
@@ -123,213 +406,173 @@ class lasair_zooniverse_class(lasair_zooniverse_base_class):
                 subject_set.save()
             else:
                 subject_set = SubjectSet().find(subject_set_id)
-            subjects = []
-            for proto_subject in proto_subjects:
-                subject = Subject()
-                subject.links.project = project
-                subject.add_location(proto_subject['location_lc'])
-                subject.add_location(proto_subject['location_ps'])
-                subject.metadata.update(proto_subject['metadata'])
-                subject.save()
-                subjects.append(subject)
-
-            subject_set.add(subjects)
             workflow.add_subject_sets(subject_set)
-        except Exception:
-            self.log.exception("Error in create_subjects_and_link_to_project ")
-        
+
+        if self.upload_journal != None:
+            self.upload_journal.start(project_id, workflow_id, subject_set.id)
+
+        return project, subject_set
+
+    def build_subject(self, project, proto_subject):
+        subject = Subject()
+        subject.links.project = project
+        subject.add_location(proto_subject['location_lc'])
+        if isinstance(proto_subject['location_ps'], bytes):
+            # a stamp kept in memory by build_stamp
+            subject.add_location(io.BytesIO(proto_subject['location_ps']), manual_mimetype='image/jpeg')
+        else:
+            subject.add_location(proto_subject['location_ps'])
+        subject.metadata.update(proto_subject['metadata'])
+        return subject
+
+
+    def objectdata_path(self, objectId, data_dir):
+        if self.object_cache != None:
+            return self.object_cache.path(objectId)
+        dirpath = os.path.join(data_dir, time.strftime("%m-%d-%Y", time.gmtime()))
+        return os.path.join(dirpath, objectId + '.json')
 
     def parse_object_data(self, objectId, data_dir):
         try:
-            dirpath = os.path.join(data_dir, time.strftime("%m-%d-%Y", time.gmtime()))
-            f=open(os.path.join(dirpath, objectId + '.json'), "r")
-            data = json.load(f)
+            f=open(self.objectdata_path(objectId, data_dir), "rb")
+            data = fast_json.load(f)
             f.close()
 
             lo = lasair_object(objectId, 0,0,0,0)
-            for key, value in data.items():
-                if key == 'objectData':
-                    objectData = value
-                    for objData in objectData:
-                        for dkey, dvalue in objectData.items():
-                            if dkey == 'ramean':
-                                lo.ramean = dvalue
-                            elif dkey == 'decmean':
-                                lo.decmean = dvalue
-                elif key == 'candidates':
-                    candidates = value
-                    print(len(candidates))
-                    for candidate in candidates:
-                        mjd = candidate['mjd']
-                        fid = candidate['fid']
-                        mag = candidate['magpsf']
-                        try:
-                          error = candidate['sigmapsf']
-                          flag = True
-                        except KeyError:
-                          mag = candidate['diffmaglim']
-                          flag = False
-                        lo.Detections.append({'mjd':mjd, 'mag':mag, 'fid':fid, 'error':error, 'detect_flag': flag})
+            objectData = data.get('objectData', {})
+            lo.ramean = objectData.get('ramean', lo.ramean)
+            lo.decmean = objectData.get('decmean', lo.decmean)
+
+            # fill the detection columns in a single pass over the candidates
+            candidates = data.get('candidates', [])
+            print(len(candidates))
+            rows = []
+            for candidate in candidates:
+                if 'sigmapsf' in candidate:
+                    rows.append((candidate['mjd'], candidate['magpsf'], candidate['sigmapsf'], candidate['fid'], True))
+                else:
+                    rows.append((candidate['mjd'], candidate['diffmaglim'], np.nan, candidate['fid'], False))
+            lo.Detections = np.array(rows, dtype=detection_dtype)
             return lo
         except Exception as e:
             print(repr(e))
             return None
     
+    def _stamp_settings(self, dirpath):
+        # panstamps downloader settings for the PS1 colour stamps
+        return dict(settings=False,
+                    fits=False,
+                    jpeg=True,
+                    arcsecSize=75,
+                    filterSet='gri',
+                    color=True,
+                    singleFilters=False,
+                    imageType="stack",
+                    downloadDirectory=dirpath,
+                    mjdStart=False,
+                    mjdEnd=False,
+                    window=False)
+
+    def _cached_stamp(self, ramean, decmean, dirpath):
+        if self.stamp_cache == None:
+            return None
+        settings = self._stamp_settings(dirpath)
+        cached = self.stamp_cache.get(ramean, decmean, settings['arcsecSize'], settings['filterSet'])
+        if cached == None:
+            return None
+        # copy rather than link, the crosshairs are drawn over the file
+        colorPath = os.path.join(dirpath, os.path.basename(cached))
+        shutil.copyfile(cached, colorPath)
+        return [colorPath]
+
+    def _cache_stamp(self, ramean, decmean, dirpath, colorPath):
+        if self.stamp_cache != None and len(colorPath) > 0:
+            settings = self._stamp_settings(dirpath)
+            self.stamp_cache.put(ramean, decmean, settings['arcsecSize'], settings['filterSet'], colorPath[0])
+
     def gather_metadata(self, ramean, decmean, dirpath):
+        colorPath = self._cached_stamp(ramean, decmean, dirpath)
+        if colorPath != None:
+            return colorPath
+
         #logger = logging.getLogger("Panstamps")
         fitsPaths, jpegPaths, colorPath = downloader(
                 log=logging.getLogger(__name__),
-                settings=False,
-                fits=False,
-                jpeg=True,
-                arcsecSize=75,
-                filterSet='gri',
-                color=True,
-                singleFilters=False,
                 ra=ramean,
                 dec=decmean,
-                imageType="stack",
-                downloadDirectory=dirpath,
-                mjdStart=False,
-                mjdEnd=False,
-                window=False
+                **self._stamp_settings(dirpath)
         ).get()
 
+        self._cache_stamp(ramean, decmean, dirpath, colorPath)
         return colorPath
+
+    def gather_metadata_batch(self, positions, dirpath):
+        # like gather_metadata for a list of (ra, dec) positions, requesting
+        # all of the stamps that are not cached concurrently
+        colorPaths = [self._cached_stamp(ramean, decmean, dirpath) for ramean, decmean in positions]
+        missing = [i for i, colorPath in enumerate(colorPaths) if colorPath == None]
+
+        results = batch_get(logging.getLogger(__name__),
+                            [positions[i] for i in missing],
+                            concurrentDownloads=self.download_workers,
+                            **self._stamp_settings(dirpath))
+        for i, result in zip(missing, results):
+            if isinstance(result, Exception):
+                colorPaths[i] = []
+                continue
+            colorPaths[i] = result[2]
+            self._cache_stamp(positions[i][0], positions[i][1], dirpath, colorPaths[i])
+        return colorPaths
     
 
     def build_plots(self, lasair_object, data_dir):
 
-        mjd_red = []
-        mag_red = []
-        yerr_red = []
-        mjd_red_limit = []
-        mag_red_limit = []
-        mjd_blue = []
-        mag_blue = []
-        yerr_blue = []
-        mjd_blue_limit = []
-        mag_blue_limit = []
-    
-        mjd_first = np.inf
-        print(len(lasair_object.Detections))
-        for detection in lasair_object.Detections:
-          print(detection)
-      
-          if detection['detect_flag']  == True:
-            if detection['mjd'] < mjd_first:
-              mjd_first = detection['mjd']
-            if detection['fid'] == 2:
-              mjd_red.append(detection['mjd'])
-              mag_red.append(detection['mag'])
-              yerr_red.append(detection['error'])
-            elif detection['fid'] == 1:
-              mjd_blue.append(detection['mjd'])
-              mag_blue.append(detection['mag'])
-              yerr_blue.append(detection['error'])
-          elif detection['detect_flag'] == False:
-            if detection['fid'] == 2:
-              mjd_red_limit.append(detection['mjd'])
-              mag_red_limit.append(detection['mag'])
-            elif detection['fid'] == 1:
-              mjd_blue_limit.append(detection['mjd'])
-              mag_blue_limit.append(detection['mag'])
-
         dirpath = os.path.join(data_dir, time.strftime("%m-%d-%Y", time.gmtime()))
 
-        font = {'family' : 'normal',
-                'size'   : 22}
-
-        matplotlib.rc('font', **font)
-
-        fig = plt.figure(figsize=(12,9))
-        ax = fig.add_subplot(111)
-
-        ax.errorbar(np.array(mjd_red) - mjd_first,
-                    mag_red,
-                    yerr=yerr_red,
-                    marker='o',
-                    markersize=10,
-                    color='#D1495B',
-                    ls='none')
-
-        ax.errorbar(np.array(mjd_blue) - mjd_first,
-                    mag_blue,
-                    yerr=yerr_blue,
-                    marker='D',
-                    markersize=10,
-                    color='#26547C',
-                    ls='none')
-
-        ax.scatter(np.array(mjd_red_limit) - mjd_first,
-                   mag_red_limit,
-                   marker='v',
-                   s=100,
-                   color='#DE7C89')
-
-        ax.scatter(np.array(mjd_blue_limit) - mjd_first,
-                   mag_blue_limit,
-                   marker='v',
-                   s=100,
-                   color='#4489C5')
+        light_curve = self.plot_lightcurve(lasair_object, dirpath)
+        panstamps = self.build_stamp(lasair_object, dirpath)
+        return light_curve, panstamps
 
-        ax.set_xlabel('Days since First Detection')
-        ax.set_ylabel('Difference Magnitude')
+    def plot_lightcurve(self, lasair_object, dirpath):
 
-        plt.grid()
-        plt.gca().invert_yaxis()
-        plt.savefig(os.path.join(dirpath, "%s_light_curve.jpeg"%(lasair_object.objectId)))
-
-
-        #now get the panstamps image
-        colorPath = self.gather_metadata(lasair_object.ramean,lasair_object.decmean, dirpath)
+        print(len(lasair_object.Detections))
 
-        #put crosshairs on the panstamps image
-        self.draw_crosshairs(lasair_object.ramean,lasair_object.decmean, colorPath)
+        # one renderer, and so one figure, is reused for every lightcurve
+        if self.renderer == None:
+            self.renderer = lightcurve_renderer.LightcurveRenderer(self.render_cache_dir, self.render_cache_max_age_days)
 
         light_curve = os.path.join(dirpath, "%s_light_curve.jpeg"%(lasair_object.objectId))
-        plots = dict({ 'light_curve': light_curve, 'panstamps': colorPath })
-        return light_curve, colorPath[0]
-    
-    def draw_crosshairs(self, ramean, decmean, colorPath):
-        im = Image.open(colorPath[0], mode='r')
+        return self.renderer.render(lasair_object, light_curve)
 
-        # DETERMINE THE SIZE OF THE IMAGE
-        imWidth, imHeight = im.size
+    def build_stamp(self, lasair_object, dirpath, colorPath=None):
 
-        # THE CROSS HAIRS SHOULD BE 1/6 THE LENGTH OF THE SMALLEST DIMENSON
-        chLen = int(min(imWidth, imHeight) / 6)
+        #get the panstamps image, unless it was already fetched by gather_metadata_batch
+        if colorPath == None:
+            colorPath = self.gather_metadata(lasair_object.ramean,lasair_object.decmean, dirpath)
+        if len(colorPath) == 0:
+            raise IOError("No PS1 colour stamp for object: " + lasair_object.objectId)
 
-        # THE GAP IN THE CENTRE SHOULD BE 1/60 OF THE LENGTH OF THE SMALLEST DIMENSON
-        gapLen = int(min(imWidth, imHeight) / 60)
-
-        
-        # LINE WIDTH SHOULD BE EASILY VIEWABLE AT ALL SIZES - 0.2% OF THE WIDTH SEEMS GOOD
-        # SEEMS FINE
-        lineWidth = int(max(imWidth, imHeight) / 300)
-
-        lines = []
-        l = (imWidth / 2 - gapLen - chLen, imHeight /
-            2, imWidth / 2 - gapLen, imHeight / 2)
-        lines.append(l)
-        l = (imWidth / 2 + gapLen, imHeight /
-            2, imWidth / 2 + gapLen + chLen, imHeight / 2)
-        lines.append(l)
-        l = (imWidth / 2, imHeight /
-            2 - gapLen - chLen, imWidth / 2, imHeight / 2 - gapLen)
-        lines.append(l)
-        l = (imWidth / 2, imHeight /
-            2 + gapLen, imWidth / 2, imHeight / 2 + gapLen + chLen)
-        lines.append(l)
-
-
-        # GENERATE THE DRAW OBJECT AND DRAW THE CROSSHAIRS
-        draw = ImageDraw.Draw(im)
-        draw.line(l, fill='#00ff00', width=lineWidth)
-        for l in lines:
-            draw.line(l, fill='#00ff00', width=lineWidth)
-
-        del draw
-
-        im.thumbnail((300, 300), Image.ANTIALIAS)
-        im.save(colorPath[0], "JPEG")
+        #put crosshairs on the panstamps image, returning its path or, if
+        #stamp_in_memory is set, the jpeg itself
+        return self.draw_crosshairs(lasair_object.ramean,lasair_object.decmean, colorPath, self.stamp_in_memory)
+    
+    def build_stamps(self, lasair_objects, colorPaths):
+        # build_stamp for a batch of objects whose stamps have already been
+        # fetched, drawing all the crosshairs in one go.  Returns the stamp
+        # (path or jpeg) of each object, or None where there is none.
+        stamps = [None] * len(lasair_objects)
+        fetched = []
+        for i, (lasair_object, colorPath) in enumerate(zip(lasair_objects, colorPaths)):
+            if len(colorPath) == 0:
+                self.log.error("No PS1 colour stamp for object: " + lasair_object.objectId)
+            else:
+                fetched.append(i)
+        annotated = crosshairs.annotate_stamps([colorPaths[i][0] for i in fetched], as_bytes=self.stamp_in_memory)
+        for i, stamp in zip(fetched, annotated):
+            stamps[i] = stamp
+        return stamps
+
+    def draw_crosshairs(self, ramean, decmean, colorPath, as_bytes=False):
+        # crosshairs marking the object at the centre of the panstamps image,
+        # drawn once the stamp is scaled down to its final size
+        return crosshairs.draw_crosshairs(colorPath[0], as_bytes=as_bytes)
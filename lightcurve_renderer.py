@@ -0,0 +1,206 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import matplotlib
+import numpy as np
+from multiprocessing import Pool
+from matplotlib.figure import Figure
+from matplotlib.transforms import nonsingular
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# style of the lightcurve plots
+font = {'family' : 'normal',
+        'size'   : 22}
+figsize = (12, 9)
+
+# fraction of the data range left empty either side, as matplotlib's autoscaling does
+margin = 0.05
+
+# style of the detections (errorbars) and limits (scatter) in each filter
+red_style = {'marker': 'o', 'markersize': 10, 'color': '#D1495B', 'ls': 'none'}
+blue_style = {'marker': 'D', 'markersize': 10, 'color': '#26547C', 'ls': 'none'}
+red_limit_style = {'marker': 'v', 's': 100, 'color': '#DE7C89'}
+blue_limit_style = {'marker': 'v', 's': 100, 'color': '#4489C5'}
+
+# everything other than the data that changes how a plot looks, so a cached
+# plot is never reused after the style changes
+style_key = repr((matplotlib.__version__, font, figsize, margin,
+                  sorted(red_style.items()), sorted(blue_style.items()),
+                  sorted(red_limit_style.items()), sorted(blue_limit_style.items())))
+
+# renderer reused by each render worker process
+_renderer = None
+
+class LightcurveRenderer(object):
+    """
+    Draws lightcurves onto a single figure that is created once and reused.
+
+    The errorbar and scatter artists are also created once and have their data
+    replaced for each object, so rendering a lightcurve allocates no new figure
+    or artists and memory stays constant however many objects are rendered.
+    The figure uses the Agg canvas directly and is never registered with
+    pyplot, so it is safe to use from a worker thread or process.
+
+    If cache_dir is given each rendered plot is also kept there under a hash
+    of the detections and the plot style.  An object whose detections have not
+    changed since it was last rendered is then linked (or copied) from the
+    cache instead of being drawn again.  Plots not used for cache_max_age_days
+    are removed from the cache when the renderer is created.
+    """
+
+    def __init__(self, cache_dir=None, cache_max_age_days=None):
+        self.cache_dir = cache_dir
+        if self.cache_dir != None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            if cache_max_age_days != None:
+                prune_cache(self.cache_dir, cache_max_age_days)
+
+        matplotlib.rc('font', **font)
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot(111)
+
+        self.red = self.ax.errorbar([], [], yerr=[], **red_style)
+        self.blue = self.ax.errorbar([], [], yerr=[], **blue_style)
+        self.red_limit = self.ax.scatter([], [], **red_limit_style)
+        self.blue_limit = self.ax.scatter([], [], **blue_limit_style)
+
+        self.ax.set_xlabel('Days since First Detection')
+        self.ax.set_ylabel('Difference Magnitude')
+        self.ax.grid()
+
+    def _set_errorbar(self, container, x, y, yerr):
+        data_line, caplines, barlinecols = container.lines
+        data_line.set_data(x, y)
+        segments = np.stack([np.column_stack([x, y - yerr]),
+                             np.column_stack([x, y + yerr])], axis=1)
+        barlinecols[0].set_segments(segments)
+
+    def _set_scatter(self, collection, x, y):
+        collection.set_offsets(np.column_stack([x, y]))
+
+    def _limits(self, values):
+        # the limits matplotlib's autoscaling gives for these values: a single
+        # value (or none) is widened by 5% of its size by the locator's
+        # nonsingular, then the margins are added
+        values = values[np.isfinite(values)]
+        if len(values) == 0:
+            lo, hi = -np.inf, np.inf
+        else:
+            lo, hi = values.min(), values.max()
+        lo, hi = nonsingular(lo, hi, expander=0.05)
+        pad = (hi - lo) * margin
+        return nonsingular(lo - pad, hi + pad, expander=0.05)
+
+    def _cache_path(self, lasair_object, path):
+        digest = hashlib.sha1(lasair_object.Detections.tobytes())
+        digest.update(style_key.encode("utf-8"))
+        extension = os.path.splitext(path)[1]
+        return os.path.join(self.cache_dir, digest.hexdigest() + extension)
+
+    def _link(self, source, destination):
+        # hard link where possible so the cache costs no extra disk space
+        if os.path.exists(destination):
+            os.remove(destination)
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copyfile(source, destination)
+
+    def render(self, lasair_object, path):
+        if self.cache_dir != None:
+            cache_path = self._cache_path(lasair_object, path)
+            if os.path.exists(cache_path):
+                # mark the plot as used, so it is kept by prune_cache
+                os.utime(cache_path)
+                self._link(cache_path, path)
+                return path
+            # path may be a link to an older cached plot, which must not be
+            # overwritten in place
+            if os.path.exists(path):
+                os.remove(path)
+
+        self.draw(lasair_object, path)
+
+        if self.cache_dir != None and not os.path.exists(cache_path):
+            self._link(path, cache_path)
+        return path
+
+    def draw(self, lasair_object, path):
+        red = lasair_object.select(2, True)
+        blue = lasair_object.select(1, True)
+        red_limit = lasair_object.select(2, False)
+        blue_limit = lasair_object.select(1, False)
+
+        detections = lasair_object.Detections[lasair_object.Detections['detect_flag']]
+        mjd_first = detections['mjd'].min() if len(detections) > 0 else np.inf
+
+        self._set_errorbar(self.red, red['mjd'] - mjd_first, red['mag'], red['error'])
+        self._set_errorbar(self.blue, blue['mjd'] - mjd_first, blue['mag'], blue['error'])
+        self._set_scatter(self.red_limit, red_limit['mjd'] - mjd_first, red_limit['mag'])
+        self._set_scatter(self.blue_limit, blue_limit['mjd'] - mjd_first, blue_limit['mag'])
+
+        # the artists are updated in place, so set the axis limits by hand,
+        # with magnitudes running from faint at the bottom to bright at the top
+        x = lasair_object.Detections['mjd'] - mjd_first
+        y = np.concatenate([red['mag'], red['mag'] - red['error'], red['mag'] + red['error'],
+                            blue['mag'], blue['mag'] - blue['error'], blue['mag'] + blue['error'],
+                            red_limit['mag'], blue_limit['mag']])
+        # matplotlib leaves out points whose x is not finite, e.g. the limits
+        # of an object with no detections
+        y_x = np.concatenate([red['mjd']] * 3 + [blue['mjd']] * 3 + [red_limit['mjd'], blue_limit['mjd']]) - mjd_first
+        y = y[np.isfinite(y_x)]
+        self.ax.set_xlim(*self._limits(x))
+        ymin, ymax = self._limits(y)
+        self.ax.set_ylim(ymax, ymin)
+
+        self.figure.savefig(path)
+        return path
+
+def prune_cache(cache_dir, max_age_days):
+    # remove the cached plots that have not been drawn or used for max_age_days
+    cutoff = time.time() - max_age_days * 86400
+    removed = 0
+    for entry in os.scandir(cache_dir):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+                removed += 1
+        except OSError:
+            # removed by another process in the meantime
+            continue
+    return removed
+
+def _init_worker(cache_dir):
+    global _renderer
+    _renderer = LightcurveRenderer(cache_dir)
+
+def _render(job):
+    lasair_object, path = job
+    try:
+        return _renderer.render(lasair_object, path)
+    except Exception:
+        logging.getLogger("lightcurve-renderer-logger").exception("Error rendering lightcurve for object: " + lasair_object.objectId)
+        return None
+
+def render_lightcurves(lasair_objects, paths, processes=None, cache_dir=None, cache_max_age_days=None):
+    """
+    Render the lightcurve of each lasair_object to the matching path using a
+    pool of processes (one per cpu by default), reusing plots from cache_dir
+    where the detections are unchanged.  Plots not used for cache_max_age_days
+    are first removed from the cache.  Returns the list of paths, with None
+    for any lightcurve that failed to render.
+    """
+    jobs = list(zip(lasair_objects, paths))
+    if len(jobs) == 0:
+        return []
+    if cache_dir != None and cache_max_age_days != None:
+        os.makedirs(cache_dir, exist_ok=True)
+        prune_cache(cache_dir, cache_max_age_days)
+    if processes == None:
+        processes = os.cpu_count()
+    chunksize = max(1, len(jobs) // (4 * processes))
+    with Pool(processes=processes, initializer=_init_worker, initargs=(cache_dir,)) as pool:
+        return pool.map(_render, jobs, chunksize=chunksize)
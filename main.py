@@ -17,20 +17,22 @@ log = logging.getLogger("main-logger")
 
 while(1):
     try:
-        lasair_zoo = lasair_zooniverse_class(config.get('APP', 'KAFKA_SERVER'), config.get('APP', 'ENDPOINT'))
-        objectIds = lasair_zoo.query_lasair_topic(config.get('APP','GROUP_ID'), config.get('APP','TOPIC'))
+        lasair_zoo = lasair_zooniverse_class(config.get('APP', 'KAFKA_SERVER'), config.get('APP', 'ENDPOINT'), object_cache_dir=config.get('APP', 'OBJECT_CACHE_DIR', fallback=None), render_cache_dir=config.get('APP', 'RENDER_CACHE_DIR', fallback=None), render_cache_max_age_days=config.getfloat('APP', 'RENDER_CACHE_MAX_AGE_DAYS', fallback=30), stamp_cache_dir=config.get('APP', 'STAMP_CACHE_DIR', fallback=None))
+        # nothing is uploaded here, so the offsets are committed as the alerts are read
+        objectIds = lasair_zoo.query_lasair_topic(config.get('APP','GROUP_ID'), config.get('APP','TOPIC'), auto_commit=True)
 
         if (config.get('APP','RECORDS_LIMIT')) != 'None':
             max_limit = config.getint('APP','RECORDS_LIMIT')
             objectIds = objectIds[:max_limit]
+        objectIds = lasair_zoo.fetch_objectdata(objectIds, config.get('APP','URL'), config.get('APP','DATA_DIR'))
         proto_subjects = []
         for object_id in objectIds:
-            lasair_zoo.wget_objectdata(object_id, config.get('APP','URL'), config.get('APP','DATA_DIR'))
             proto_subject = lasair_zoo.produce_proto_subject(object_id, config.get('APP','DATA_DIR'))
             if (proto_subject != None):
                 proto_subjects.append(proto_subject)
 
         #lasair_zoo.create_subjects_and_link_to_project(proto_subjects,config.get('APP','PROJECT_ID'), config.get('APP','WORKFLOW_ID'), None)
+        lasair_zoo.close_lasair_topic()
         time.sleep(config.getint('APP','SLEEP_TIME')) #sleep for one day
     except Exception:
         log.exception("Error in main block")
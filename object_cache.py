@@ -0,0 +1,72 @@
+import os
+import json
+import fast_json
+
+class object_cache:
+    """
+    Persistent on-disk cache of the Lasair object json, keyed by objectId.
+
+    Alongside each <objectId>.json the cache keeps <objectId>.meta.json holding
+    the ETag and Last-Modified headers of the last download, so repeat objects
+    can be fetched with a conditional request and are only downloaded again
+    when Lasair has changed them.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def path(self, objectId):
+        return os.path.join(self.cache_dir, objectId + '.json')
+
+    def _meta_path(self, objectId):
+        return os.path.join(self.cache_dir, objectId + '.meta.json')
+
+    def _read(self, path):
+        try:
+            with open(path, 'rb') as f:
+                return fast_json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _write(self, path, data):
+        # write to a temporary file first so a crash never leaves a truncated file
+        with open(path + '.part', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.part', path)
+
+    def conditional_headers(self, objectId):
+        # headers that let the server answer 304 Not Modified for a cached object
+        meta = self._read(self._meta_path(objectId))
+        headers = {}
+        if meta == None or not os.path.exists(self.path(objectId)):
+            return headers
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def update(self, objectId, response):
+        # replace the cached object with a full (200) response, which holds
+        # every candidate including any Lasair added or corrected at earlier
+        # MJDs, and record the response headers for the next request.
+        # Returns the number of candidates that were not in the cached copy.
+        data = fast_json.loads(response.content)
+        cached = self._read(self.path(objectId)) or {}
+
+        cached_candidates = set(self._candidate_key(c) for c in cached.get('candidates', []))
+        new_candidates = [c for c in data.get('candidates', []) if self._candidate_key(c) not in cached_candidates]
+
+        self._write(self.path(objectId), data)
+        self._write(self._meta_path(objectId), {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+        })
+        return len(new_candidates)
+
+    def _candidate_key(self, candidate):
+        # detections have a candid, non-detections are told apart by time and filter
+        if candidate.get('candid') != None:
+            return candidate['candid']
+        return (candidate.get('mjd'), candidate.get('fid'))
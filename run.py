@@ -5,6 +5,7 @@ import logging
 from configparser import ConfigParser
 from lasair_zooniverse import lasair_zooniverse_class
 from lasair_zooniverse import lasair_object
+from lasair_pipeline import lasair_pipeline
 import time
 import numpy as np
 ################################   
@@ -17,7 +18,43 @@ def main():
 
   # Instantiate lasair-Zooniverse interface class
   lasair_zoo = lasair_zooniverse_class(config.get('APP', 'KAFKA_SERVER'),
-                                       config.get('APP', 'ENDPOINT'))
+                                       config.get('APP', 'ENDPOINT'),
+                                       config.getint('APP', 'DOWNLOAD_WORKERS', fallback=8),
+                                       config.getint('APP', 'DOWNLOAD_TIMEOUT', fallback=30),
+                                       config.getint('APP', 'DOWNLOAD_RETRIES', fallback=3),
+                                       config.get('APP', 'OBJECT_CACHE_DIR', fallback=None),
+                                       config.get('APP', 'RENDER_CACHE_DIR', fallback=None),
+                                       config.get('APP', 'STAMP_CACHE_DIR', fallback=None),
+                                       config.getint('APP', 'STAMP_CACHE_MAX_MB', fallback=1000),
+                                       config.getfloat('APP', 'STAMP_CACHE_TOLERANCE', fallback=1.0),
+                                       config.getfloat('APP', 'STAMP_CACHE_MATCH_RADIUS', fallback=1.0),
+                                       config.getboolean('APP', 'STAMP_IN_MEMORY', fallback=False),
+                                       config.get('APP', 'UPLOAD_JOURNAL', fallback=None),
+                                       config.getint('APP', 'MAX_POLL_INTERVAL_MS', fallback=300000),
+                                       config.getfloat('APP', 'RENDER_CACHE_MAX_AGE_DAYS', fallback=30),
+                                       config.getint('APP', 'MAX_ATTEMPTS', fallback=3),
+                                       config.getfloat('APP', 'SUBJECT_SET_MAX_AGE_DAYS', fallback=7))
+
+  # If a limit on the number of objects to process is set, read it here
+  max_limit = None
+  if (config.get('APP','RECORDS_LIMIT')) != 'None':
+    max_limit = config.getint('APP','RECORDS_LIMIT')
+
+  # In streaming mode each alert is downloaded, plotted, stamped and uploaded
+  # as soon as it arrives on the kafka stream, with all of the stages running
+  # concurrently.  Otherwise the whole topic is drained before processing.
+  if config.getboolean('APP', 'STREAMING', fallback=False):
+    pipeline = lasair_pipeline(lasair_zoo,
+                               config.get('APP','URL'),
+                               config.get('APP','DATA_DIR'),
+                               config.getint('APP','QUEUE_SIZE', fallback=10))
+    pipeline.run(config.get('APP','GROUP_ID'),
+                 config.get('APP','TOPIC'),
+                 config.get('APP','PROJECT_ID'),
+                 config.get('APP','WORKFLOW_ID'),
+                 None,
+                 max_limit)
+    return
 
   # Query lasair kafka stream for objects according to group id and the
   # topic (aka. Stream name at https://lasair.roe.ac.uk/streams/)
@@ -26,33 +63,30 @@ def main():
 
   # If a limit on the number of objects to process is set, truncate the object
   # list accordingly
-  if (config.get('APP','RECORDS_LIMIT')) != 'None':
-    max_limit = config.getint('APP','RECORDS_LIMIT')
+  if max_limit != None:
     objectIds = objectIds[:max_limit]
 
-  # Create an empty list to track the proto-subjects.
-  proto_subjects = []
+  # Grab the lightcurve data for all of the objects from lasair.  The downloads
+  # run concurrently and any objects that fail to download are dropped.
+  fetched = lasair_zoo.fetch_objectdata(objectIds,
+                                        config.get('APP','URL'),
+                                        config.get('APP','DATA_DIR'))
+  failed = [objectId for objectId in objectIds if objectId not in fetched]
 
-  # Iterate through the objects queried from lasair
-  for object_id in objectIds:
-    # Grab the lightcurve data for each subject from lasair
-    lasair_zoo.wget_objectdata(object_id,
-                               config.get('APP','URL'),
-                               config.get('APP','DATA_DIR'))
-  
-    # Create a proto-subject for this objects.  A proto-subject gathers the
-    # information required to construct a subject for the Zooniverse.  In this
-    # case the lasair_zoo.produce_proto_subject produces a lightcurve plot,
-    # from the data downloaded above from lasair.  This method also gets a
-    # PanSTARRS-1 image at the transient location with panstamps
-    # (https://github.com/thespacedoctor/panstamps).
-    proto_subject = \
-      lasair_zoo.produce_proto_subject(object_id, config.get('APP','DATA_DIR'))
-  
-    # If everything went well in the previous step add this to our list of
-    # proto-subjects
-    if (proto_subject != None):
-      proto_subjects.append(proto_subject)
+  # Create a proto-subject for each object.  A proto-subject gathers the
+  # information required to construct a subject for the Zooniverse.  In this
+  # case lasair_zoo.produce_proto_subjects produces a lightcurve plot from the
+  # data downloaded above from lasair, rendering the plots in parallel across
+  # RENDER_PROCESSES processes (one per cpu if not set).  This method also gets
+  # a PanSTARRS-1 image at the transient location with panstamps
+  # (https://github.com/thespacedoctor/panstamps).  Objects for which anything
+  # went wrong are left out of the list.
+  render_processes = None
+  if config.get('APP','RENDER_PROCESSES', fallback='None') != 'None':
+    render_processes = config.getint('APP','RENDER_PROCESSES')
+  proto_subjects = lasair_zoo.produce_proto_subjects(fetched,
+                                                     config.get('APP','DATA_DIR'),
+                                                     render_processes)
 
   # The lasair_zoo.create_subjects_and_link_to_project take the list of
   # proto-subjects and produce subjects for the Zooniverse project.  The method
@@ -60,10 +94,23 @@ def main():
   # workflow corresponding to the project and workflow ids provided in the
   # config. In this example the subjects are linked to the Superluminous \
   # Supernova project.
-  lasair_zoo.create_subjects_and_link_to_project(proto_subjects,
-                                                 config.get('APP','PROJECT_ID'),
-                                                 config.get('APP','WORKFLOW_ID'),
-                                                 None)
+  subject_set, uploaded = lasair_zoo.create_subjects_and_link_to_project(proto_subjects,
+                                                                         config.get('APP','PROJECT_ID'),
+                                                                         config.get('APP','WORKFLOW_ID'),
+                                                                         None)
+
+  failed += [proto_subject['metadata']['objectId'] for proto_subject in proto_subjects
+             if proto_subject['metadata']['objectId'] not in uploaded]
+
+  # Only now that the subjects are on the Zooniverse do we commit the kafka
+  # offsets.  Objects that failed to download or upload are held back (up to
+  # MAX_ATTEMPTS runs) so the next run sees their alerts again, and while any
+  # are held back the subject set stays open, so the next run carries on with
+  # it and the upload journal stops any subject being uploaded twice.  Objects
+  # left out by RECORDS_LIMIT, or that could not be turned into a subject, are
+  # logged as skipped and their alerts committed.
+  if lasair_zoo.commit_lasair_topic(uploaded, failed) and subject_set != None:
+    lasair_zoo.finish_subject_set(subject_set)
 
 if __name__ == '__main__':
   main()
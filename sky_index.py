@@ -0,0 +1,73 @@
+import math
+
+class sky_index:
+    """
+    Spatial hash of sky positions for fast "what is within X arcsec" queries.
+
+    Positions are stored as unit vectors, bucketed into a cubic grid whose cell
+    size is the chord length of cell_radius arcsec.  A query only has to look in
+    the cells neighbouring the query position, so its cost does not grow with
+    the number of positions stored.
+    """
+
+    def __init__(self, cell_radius=1.0):
+        self.cell = self._chord(cell_radius)
+        self.buckets = {}
+        self.positions = {}
+
+    def _chord(self, radius):
+        # straight line distance between two unit vectors radius arcsec apart
+        return 2. * math.sin(math.radians(radius / 3600.) / 2.)
+
+    def _vector(self, ra, dec):
+        ra = math.radians(float(ra))
+        dec = math.radians(float(dec))
+        return (math.cos(dec) * math.cos(ra), math.cos(dec) * math.sin(ra), math.sin(dec))
+
+    def _cell(self, vector):
+        return tuple(int(math.floor(v / self.cell)) for v in vector)
+
+    def cell_of(self, ra, dec):
+        # the grid cell holding (ra, dec), the same size everywhere on the sky
+        return self._cell(self._vector(ra, dec))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def add(self, key, ra, dec):
+        self.remove(key)
+        vector = self._vector(ra, dec)
+        self.positions[key] = vector
+        self.buckets.setdefault(self._cell(vector), set()).add(key)
+
+    def remove(self, key):
+        vector = self.positions.pop(key, None)
+        if vector == None:
+            return
+        cell = self._cell(vector)
+        self.buckets[cell].discard(key)
+        if len(self.buckets[cell]) == 0:
+            del self.buckets[cell]
+
+    def nearest(self, ra, dec, radius):
+        # the (key, separation in arcsec) of the closest position within
+        # radius arcsec of (ra, dec), or None
+        vector = self._vector(ra, dec)
+        max_chord = self._chord(radius)
+        reach = int(math.ceil(max_chord / self.cell))
+        i, j, k = self._cell(vector)
+
+        best_key = None
+        best_chord = max_chord
+        for di in range(-reach, reach + 1):
+            for dj in range(-reach, reach + 1):
+                for dk in range(-reach, reach + 1):
+                    for key in self.buckets.get((i + di, j + dj, k + dk), ()):
+                        chord = math.dist(vector, self.positions[key])
+                        if chord <= best_chord:
+                            best_key = key
+                            best_chord = chord
+        if best_key == None:
+            return None
+        separation = math.degrees(2. * math.asin(min(1., best_chord / 2.))) * 3600.
+        return best_key, separation
@@ -0,0 +1,103 @@
+import os
+import time
+import shutil
+import sqlite3
+import threading
+from sky_index import sky_index
+
+class stamp_cache:
+    """
+    Persistent cache of PanSTARRS-1 colour stamps keyed by sky position.
+
+    Stamps are stored under the cell of a grid tolerance arcsec across that
+    (ra, dec) falls in, together with the stamp size and filter set, in a small sqlite database kept next to
+    the cached images.  Once the cached images add up to more than max_bytes the
+    least recently used ones are removed.
+
+    Lookups go through an in-memory sky_index of the stamp centres, so a stamp
+    is reused for any position within match_radius arcsec of its centre, e.g.
+    when the ZTF position of an object drifts slightly between alerts.  The
+    crosshairs mark the stamp centre, so keep match_radius to a small fraction
+    of the stamp size.
+    """
+
+    def __init__(self, cache_dir, max_bytes=1000*1024*1024, tolerance=1.0, match_radius=1.0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self.match_radius = match_radius
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+        # the grid of the sky the stamps are keyed on.  It is cut in unit
+        # vector space, so a cell is tolerance arcsec across at any declination
+        # (rounding ra in degrees would shrink the cells towards the poles)
+        self.grid = sky_index(self.tolerance)
+
+        # the cache may be shared by the threads of the streaming pipeline
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.cache_dir, 'index.db'), check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS stamps (key TEXT PRIMARY KEY, ra REAL, dec REAL, arcsecSize INTEGER, filterSet TEXT, path TEXT, size INTEGER, last_access REAL)''')
+        self.conn.execute('''CREATE INDEX IF NOT EXISTS stamps_last_access ON stamps (last_access)''')
+        self.conn.commit()
+
+        # one spatial index per stamp size and filter set
+        self.indexes = {}
+        for key, ra, dec, arcsecSize, filterSet in self.conn.execute("SELECT key, ra, dec, arcsecSize, filterSet FROM stamps"):
+            self._index(arcsecSize, filterSet).add(key, ra, dec)
+
+    def _index(self, arcsecSize, filterSet):
+        if (arcsecSize, filterSet) not in self.indexes:
+            self.indexes[(arcsecSize, filterSet)] = sky_index(max(self.match_radius, self.tolerance))
+        return self.indexes[(arcsecSize, filterSet)]
+
+    def _key(self, ra, dec, arcsecSize, filterSet):
+        return "%d_%d_%d_%s_%s" % (self.grid.cell_of(ra, dec) + (arcsecSize, filterSet))
+
+    def get(self, ra, dec, arcsecSize, filterSet, radius=None):
+        # path of the cached stamp centred closest to this position, within
+        # radius arcsec (match_radius by default), or None
+        if radius == None:
+            radius = self.match_radius
+        with self.lock:
+            index = self._index(arcsecSize, filterSet)
+            match = index.nearest(ra, dec, radius)
+            if match == None:
+                return None
+            key = match[0]
+            row = self.conn.execute("SELECT path FROM stamps WHERE key=?", (key,)).fetchone()
+            if row == None or not os.path.exists(row[0]):
+                self.conn.execute("DELETE FROM stamps WHERE key=?", (key,))
+                self.conn.commit()
+                index.remove(key)
+                return None
+            self.conn.execute("UPDATE stamps SET last_access=? WHERE key=?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def put(self, ra, dec, arcsecSize, filterSet, stamp_path):
+        # copy a freshly downloaded stamp into the cache
+        key = self._key(ra, dec, arcsecSize, filterSet)
+        path = os.path.join(self.cache_dir, key + os.path.splitext(stamp_path)[1])
+        shutil.copyfile(stamp_path, path)
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO stamps VALUES (?,?,?,?,?,?,?,?)",
+                              (key, float(ra), float(dec), arcsecSize, filterSet, path, os.path.getsize(path), time.time()))
+            self.conn.commit()
+            self._index(arcsecSize, filterSet).add(key, ra, dec)
+            self._evict()
+        return path
+
+    def _evict(self):
+        # drop the least recently used stamps until the cache fits in max_bytes
+        total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM stamps").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, path, size, arcsecSize, filterSet in self.conn.execute("SELECT key, path, size, arcsecSize, filterSet FROM stamps ORDER BY last_access").fetchall():
+            if total <= self.max_bytes:
+                break
+            if os.path.exists(path):
+                os.remove(path)
+            self.conn.execute("DELETE FROM stamps WHERE key=?", (key,))
+            self._index(arcsecSize, filterSet).remove(key)
+            total -= size
+        self.conn.commit()
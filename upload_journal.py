@@ -0,0 +1,99 @@
+import os
+import time
+import sqlite3
+import threading
+
+class upload_journal:
+    """
+    Local record of the subjects uploaded to the Zooniverse, so an upload that
+    fails part way through can be finished by the next run instead of being
+    started again from scratch.
+
+    Each object moves from 'saved' (the subject exists on panoptes, with the
+    subject id recorded) to 'linked' (the subject is in its subject set).  A
+    rerun skips linked objects, links saved ones without uploading them again,
+    and only uploads the rest.  The subject set a run uploads to stays open
+    until every subject is linked, and a rerun for the same project and
+    workflow carries on with that subject set rather than creating a new one.
+
+    The journal also counts the runs in which each object failed to download
+    or upload, so an object that keeps failing can be given up on.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        # the journal may be shared by the threads of the streaming pipeline
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS uploads (objectId TEXT, subject_set_id TEXT, subject_id TEXT, state TEXT, updated REAL, PRIMARY KEY (objectId, subject_set_id))''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS subject_sets (subject_set_id TEXT PRIMARY KEY, project_id TEXT, workflow_id TEXT, open INTEGER, updated REAL, created REAL)''')
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS failures (objectId TEXT PRIMARY KEY, attempts INTEGER, updated REAL)''')
+        # journals from before subject sets recorded when they were started
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(subject_sets)")]
+        if 'created' not in columns:
+            self.conn.execute("ALTER TABLE subject_sets ADD COLUMN created REAL")
+            self.conn.execute("UPDATE subject_sets SET created=updated")
+        self.conn.commit()
+
+    def open_subject_set(self, project_id, workflow_id, max_age_days=None):
+        # id of the unfinished subject set of the last run for this project
+        # and workflow, or None.  A subject set started more than max_age_days
+        # ago is finished instead, so the run starts a new one.
+        with self.lock:
+            row = self.conn.execute("SELECT subject_set_id, created FROM subject_sets WHERE project_id=? AND workflow_id=? AND open=1 ORDER BY updated DESC LIMIT 1",
+                                    (str(project_id), str(workflow_id))).fetchone()
+        if row == None:
+            return None
+        if max_age_days != None and time.time() - row[1] > max_age_days * 86400:
+            self.finish(row[0])
+            return None
+        return row[0]
+
+    def start(self, project_id, workflow_id, subject_set_id):
+        # mark the subject set as in use until finish is called
+        now = time.time()
+        with self.lock:
+            self.conn.execute('''INSERT INTO subject_sets VALUES (?,?,?,1,?,?)
+                                 ON CONFLICT(subject_set_id) DO UPDATE SET open=1, updated=excluded.updated''',
+                              (str(subject_set_id), str(project_id), str(workflow_id), now, now))
+            self.conn.commit()
+
+    def finish(self, subject_set_id):
+        with self.lock:
+            self.conn.execute("UPDATE subject_sets SET open=0, updated=? WHERE subject_set_id=?",
+                              (time.time(), str(subject_set_id)))
+            self.conn.commit()
+
+    def get(self, objectId, subject_set_id):
+        # (state, subject_id) of the object in this subject set, or None
+        with self.lock:
+            return self.conn.execute("SELECT state, subject_id FROM uploads WHERE objectId=? AND subject_set_id=?",
+                                     (objectId, str(subject_set_id))).fetchone()
+
+    def saved(self, subject_set_id, subjects):
+        # subjects is a list of (objectId, subject_id) created on panoptes
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("INSERT OR REPLACE INTO uploads VALUES (?,?,?,'saved',?)",
+                                  [(objectId, str(subject_set_id), str(subject_id), now) for objectId, subject_id in subjects])
+            self.conn.commit()
+
+    def linked(self, subject_set_id, objectIds):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("UPDATE uploads SET state='linked', updated=? WHERE objectId=? AND subject_set_id=?",
+                                  [(now, objectId, str(subject_set_id)) for objectId in objectIds])
+            self.conn.commit()
+
+    def failed(self, objectIds):
+        # count another failed run for each object, returning {objectId: runs failed}
+        now = time.time()
+        with self.lock:
+            self.conn.executemany('''INSERT INTO failures VALUES (?,1,?)
+                                     ON CONFLICT(objectId) DO UPDATE SET attempts=attempts+1, updated=excluded.updated''',
+                                  [(objectId, now) for objectId in objectIds])
+            self.conn.commit()
+            return {objectId: self.conn.execute("SELECT attempts FROM failures WHERE objectId=?", (objectId,)).fetchone()[0]
+                    for objectId in objectIds}